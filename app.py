@@ -1,303 +1,125 @@
-import os
-import sqlite3
 import json
-from datetime import datetime
-import mysql.connector
+import queue
+import time
 from datetime import datetime, timedelta
 
-from flask import Flask, render_template_string, redirect, url_for, request
-from openai import OpenAI
-
-# Load configuration (ensure config.json exists with the required keys)
-with open('config.json', 'r') as file:
-    data = json.load(file)
-
-# --- Global Configuration & Globals ---
-DB_FILE = 'telegram_bot.db'
-client = OpenAI(api_key=data['openai_api_key'])
-
-# --- Database Helper Functions ---
-
-def init_db():
-    """Initialize the SQLite database with required tables."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    # Chats table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER UNIQUE,
-            chat_name TEXT,
-            created_at TEXT
-        )
-    ''')
-    # Messages table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER,
-            user_id INTEGER,
-            content TEXT,
-            timestamp TEXT,
-            FOREIGN KEY (chat_id) REFERENCES Chats(chat_id)
-        )
-    ''')
-    # Analyses table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Analyses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            analysis_result TEXT,
-            updated_at TEXT
-        )
-    ''')
-    # MessageStats table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS MessageStats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            date TEXT,  
-            message_count INTEGER,
-            UNIQUE(user_id, date)
-        )
-    ''')
-    # Authorizations table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Authorizations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            age TEXT,
-            gender TEXT,
-            country TEXT,
-            created_at TEXT
-        )
-    ''')
-    # UserMentalHealth table for storing mental health risk data
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS UserMentalHealth (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            mental_percent REAL,
-            risk_category TEXT,
-            updated_at TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-def get_all_authorizations():
-    """Return all authorization records from the database."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, age, gender, country, created_at FROM Authorizations")
-    users = cursor.fetchall()
-    conn.close()
-    return users
-
-def get_authorization_by_user(user_id: int):
-    """Return the authorization record for a given user_id."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, age, gender, country, created_at FROM Authorizations WHERE user_id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
-
-def get_user_messages(user_id: int):
-    """Retrieve all messages sent by the user, ordered by timestamp."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT content, timestamp FROM Messages WHERE user_id = ? ORDER BY timestamp", (user_id,))
-    messages = cursor.fetchall()
-    conn.close()
-    return messages
-
-def get_user_history(user_id: int) -> str:
-    """Combine all messages of a given user into a single string."""
-    messages = get_user_messages(user_id)
-    history_lines = [f"[{ts}] {content}" for content, ts in messages]
-    return "\n".join(history_lines)
-
-def update_user_analysis(user_id: int, analysis_result: str):
-    """Insert or update the analysis result for a given user in the Analyses table."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    now = datetime.now().isoformat()
-    cursor.execute('''
-        INSERT OR REPLACE INTO Analyses (id, user_id, analysis_result, updated_at)
-        VALUES (
-            (SELECT id FROM Analyses WHERE user_id = ?),
-            ?, ?, ?
-        )
-    ''', (user_id, user_id, analysis_result, now))
-    conn.commit()
-    conn.close()
-
-def get_user_analysis(user_id: int):
-    """Retrieve the latest analysis result for a given user from the Analyses table."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT analysis_result, updated_at FROM Analyses WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return row if row else ("No analysis available.", "")
-
-def insert_authorization(user_id: int, age: str, gender: str, country: str):
-    """Insert or update authorization data for a given user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    now = datetime.now().isoformat()
-    cursor.execute('''
-        INSERT OR REPLACE INTO Authorizations (user_id, age, gender, country, created_at)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, age, gender, country, now))
-    conn.commit()
-    conn.close()
-
-def get_message_stats(user_id: int) -> list:
-    """Retrieve daily message statistics for a given user (date, message_count)."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT date, message_count FROM MessageStats
-        WHERE user_id = ?
-        ORDER BY date ASC
-    ''', (user_id,))
-    stats = cursor.fetchall()
-    conn.close()
-    return stats
-
-def get_distribution(column: str):
-    """Return labels and counts for a given column in Authorizations."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT {column}, COUNT(*) FROM Authorizations GROUP BY {column}")
-    rows = cursor.fetchall()
-    conn.close()
-    labels = [row[0] for row in rows]
-    counts = [row[1] for row in rows]
-    return labels, counts
-
-def update_user_mental_health(user_id: int, mental_percent: float, risk_category: str):
-    """Insert or update the mental health risk percentage for a given user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    now = datetime.now().isoformat()
-    cursor.execute('''
-        INSERT OR REPLACE INTO UserMentalHealth (user_id, mental_percent, risk_category, updated_at)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, mental_percent, risk_category, now))
-    conn.commit()
-    conn.close()
-
-def get_user_mental_health(user_id: int):
-    """Retrieve mental health risk data for a given user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT mental_percent, risk_category, updated_at FROM UserMentalHealth WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return row if row else (None, None, None)
-
-# --- OpenAI Analysis Function ---
-
-def analyze_user_messages(user_history: str, window_size: int = 10) -> (bool, str):
-    messages_list = [msg.strip() for msg in user_history.split("\n") if msg.strip()]
-    if len(" ".join(messages_list).split()) < 50:
-        return (False, "Not enough data for analysis.")
-    
-    recent_history = "\n".join(messages_list[-window_size:])
-    prompt = (
-        "Analyze the following user's conversation history for signs of psychological distress or indicators that "
-        "the user might benefit from psychological analysis. Give extra weight to the most recent messages. If the most recent "
-        "messages indicate improvement or resolution of previous issues, reflect that in your analysis. Respond with either:\n"
-        "'yes: <brief explanation>' if concern is detected, or\n"
-        "'no: <brief explanation>' if no concern is detected.\n\n"
-        "Recent conversation history:\n" + recent_history
-    )
-    
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Analyzing user conversation history."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=100
-    )
-    result = response.choices[0].message.content.strip().lower()
-    if result.startswith("yes:"):
-        explanation = result[4:].strip()
-        return (True, explanation)
-    return (False, result[3:].strip() if result.startswith("no:") else result)
-
-# --- OpenAI GPT Agent Functions for Conversational Replies ---
-
-def get_ai_response(user_message: str) -> str:
-    """Generate a conversational reply using GPT-3.5-turbo."""
-    with open("promt.txt", "r") as f:
-        system_prompt = f.read()
-    messages = [
-       {"role": "system", "content": system_prompt},
-       {"role": "user", "content": user_message}
-    ]
-    response = client.chat.completions.create(
-         model="gpt-3.5-turbo",
-         messages=messages,
-         max_tokens=150,
-         temperature=0.7,
-         top_p=1
-    )
-    return response.choices[0].message.content.strip()
-
-# --- New Analysis Function for Mental Health Risk Percentage ---
-
-def get_mental_health_percentage(user_history: str) -> (float, str):
-    """
-    Use OpenAI's GPT-3.5-turbo to analyze the user's conversation history and return a mental health risk percentage (0-100)
-    along with a risk category.
-    Expected output format: "NUMBER: CATEGORY" (e.g., "15: Green").
-    """
-    messages_list = [msg.strip() for msg in user_history.split("\n") if msg.strip()]
-    if len(" ".join(messages_list).split()) < 50:
-        return (0.0, "Green")
-    
-    recent_history = "\n".join(messages_list[-10:])
-    prompt = (
-        "Based on the following user's conversation history, provide a mental health risk percentage from 0 to 100. "
-        "0 means the user is completely okay, and 100 means extremely high risk. Then, assign a risk category as follows: "
-        "0-20: Green (you are okay), 20-40: Orange (a little problem), 40-60: Yellow (moderate concern), above 60: Red (immediate help needed). "
-        "Output your answer in the format: NUMBER: CATEGORY. For example, '15: Green'.\n\n"
-        "Conversation history:\n" + recent_history
-    )
-    
-    response = client.chat.completions.create(
-         model="gpt-3.5-turbo",
-         messages=[
-              {"role": "system", "content": "Analyze mental health risk."},
-              {"role": "user", "content": prompt}
-         ],
-         max_tokens=50
-    )
-    result = response.choices[0].message.content.strip()
-    try:
-         parts = result.split(":")
-         percent = float(parts[0].strip())
-         category = parts[1].strip() if len(parts) > 1 else ""
-         return (percent, category)
-    except Exception as e:
-         return (0.0, "Green")
+from flask import Flask, Response, g, render_template_string, redirect, url_for, request
+
+import metrics
+import query_profiler
+from core import events, usage
+from core.config import get_config
+from core.db import (
+    get_all_authorizations,
+    get_authorization_by_user,
+    get_daily_risk,
+    get_deteriorating_users,
+    get_distribution,
+    get_message_stats,
+    get_reply_latency,
+    get_risk_histories,
+    get_user_analysis,
+    get_user_history,
+    get_user_mental_health,
+    get_user_messages,
+    init_db,
+    update_user_analysis,
+)
+from core.llm import analyze_user_messages
 
 # --- Flask Application Setup ---
 app = Flask(__name__)
 
-# Ensure the database is initialized
-init_db()
+# The schema is created explicitly (`flask --app app init-db` or `python app.py`), not on import.
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the database tables."""
+    init_db()
+
+# --- Request Instrumentation ---
+metrics.describe("analyzebot_http_request_seconds", "Flask request latency in seconds by endpoint.")
+metrics.describe("analyzebot_http_inflight_requests", "Requests currently being handled by this worker.")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    query_profiler.PROFILER.begin_scope(request.endpoint or request.path)
+    metrics.add_gauge("analyzebot_http_inflight_requests", 1)
+
+@app.teardown_request
+def record_request_latency(exc):
+    started = g.pop("request_started", None)
+    if started is None:
+        return
+    query_profiler.PROFILER.end_scope()
+    endpoint = request.endpoint or "unknown"
+    metrics.add_gauge("analyzebot_http_inflight_requests", -1)
+    metrics.observe("analyzebot_http_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+    if exc is not None:
+        metrics.inc("analyzebot_http_request_errors_total", endpoint=endpoint)
+
+# Prometheus scrape endpoint
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def sparkline_points(values, width=120, height=30):
+    """SVG polyline points for a 0-100 score series."""
+    if len(values) < 2:
+        return ""
+    step = width / (len(values) - 1)
+    return " ".join(f"{i * step:.1f},{height - min(max(v or 0, 0), 100) * height / 100:.1f}"
+                    for i, v in enumerate(values))
+
+# Live feed: Server-Sent Events from the Events tables. Browsers resume after the
+# Last-Event-ID cursor they saw (or `after`, the cursor the page was rendered at).
+@app.route("/events/stream")
+def event_stream():
+    resume = request.headers.get("Last-Event-ID") or request.args.get("after")
+    # Without a cursor to resume from, the feed starts at the current end.
+    last_sent = events.parse_cursor(resume) or events.current_cursor()
+    subscriber = events.HUB.subscribe()
+
+    def stream():
+        sent = last_sent
+        try:
+            yield "retry: 3000\n\n"
+            # Replay what was missed; live events queued meanwhile are de-duplicated by the cursor.
+            while True:
+                missed = events.events_after(sent)
+                for event in missed:
+                    sent = events.advance(sent, event)
+                    yield format_sse(event, sent)
+                if len(missed) < events.EVENT_BATCH:
+                    break
+            while True:
+                try:
+                    event = subscriber.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                if events.is_seen(sent, event):
+                    continue
+                sent = events.advance(sent, event)
+                yield format_sse(event, sent)
+        finally:
+            events.HUB.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def format_sse(event, cursor):
+    return f"id: {events.format_cursor(cursor)}\nevent: {event['kind']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
 
 # Dashboard: list all users as cards with pie charts and a risk filter form
 @app.route("/")
 def dashboard():
     # Get optional filter from query parameter (risk category)
     risk_filter = request.args.get("risk", "All")
+    # Read before the queries: the live feed resumes from here, so nothing written meanwhile is lost.
+    last_event_id = events.format_cursor(events.current_cursor())
     auth_users = get_all_authorizations()
     users = []
     for u in auth_users:
@@ -319,6 +141,11 @@ def dashboard():
             "risk_category": risk_category,
             "mental_updated": mental_updated
         })
+    # Risk trend of every card in one query per shard.
+    histories = get_risk_histories([user["user_id"] for user in users])
+    for user in users:
+        user["history"] = histories[user["user_id"]]
+        user["sparkline"] = sparkline_points(user["history"])
     # Get distribution data for age, gender, country
     age_labels, age_counts = get_distribution("age")
     gender_labels, gender_counts = get_distribution("gender")
@@ -333,8 +160,31 @@ def dashboard():
         <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
       </head>
       <body>
+        {% macro user_card(user) %}
+              <div class="col-md-4 user-card" data-user-id="{{ user.user_id }}" data-updated="{{ user.mental_updated }}">
+                <div class="card mb-4">
+                  <div class="card-body">
+                    <h5 class="card-title">User ID: <span class="user-id">{{ user.user_id }}</span></h5>
+                    <p class="card-text">
+                      <strong>Age:</strong> <span class="age">{{ user.age }}</span><br>
+                      <strong>Gender:</strong> <span class="gender">{{ user.gender }}</span><br>
+                      <strong>Country:</strong> <span class="country">{{ user.country }}</span><br>
+                      <strong>Mental Health:</strong> <span class="mental-percent">{{ user.mental_percent }}</span>% (<span class="risk-category">{{ user.risk_category }}</span>)<br>
+                      <small class="text-muted last-message"></small>
+                    </p>
+                    <svg width="120" height="30" class="d-block mb-2" aria-label="Risk trend">
+                      <polyline class="sparkline" data-values='{{ user.history|tojson }}' points="{{ user.sparkline }}" fill="none" stroke="#dc3545" stroke-width="1.5"/>
+                    </svg>
+                    <a href="{{ url_for('user_detail', user_id=user.user_id or 0) }}" class="btn btn-primary">View Details</a>
+                  </div>
+                </div>
+              </div>
+        {% endmacro %}
         <div class="container mt-4">
+          <div id="alerts" style="position: sticky; top: 0; z-index: 10;"></div>
           <h1>User Dashboard</h1>
+          <a href="{{ url_for('deteriorating_users') }}" class="btn btn-outline-danger mb-3">Deteriorating Users</a>
+          <a href="{{ url_for('llm_usage') }}" class="btn btn-outline-secondary mb-3">LLM Usage</a>
           
           <!-- Risk Filter Form -->
           <form method="get" action="{{ url_for('dashboard') }}" class="mb-4">
@@ -364,32 +214,55 @@ def dashboard():
             </div>
           </div>
           
-          <div class="row">
+          <div class="mb-4" id="cohort-panel">
+            <h4>Messages per Day by
+              <select id="cohort-by" class="form-control form-control-sm d-inline-block" style="width: auto;">
+                <option value="risk">Risk Category</option>
+                <option value="country">Country</option>
+                <option value="age">Age</option>
+                <option value="gender">Gender</option>
+              </select>
+            </h4>
+            <canvas id="cohortChart" height="80"></canvas>
+          </div>
+
+          <div class="row" id="user-cards">
             {% for user in users %}
-              <div class="col-md-4">
-                <div class="card mb-4">
-                  <div class="card-body">
-                    <h5 class="card-title">User ID: {{ user.user_id }}</h5>
-                    <p class="card-text">
-                      <strong>Age:</strong> {{ user.age }}<br>
-                      <strong>Gender:</strong> {{ user.gender }}<br>
-                      <strong>Country:</strong> {{ user.country }}<br>
-                      <strong>Mental Health:</strong> {{ user.mental_percent }}% ({{ user.risk_category }})
-                    </p>
-                    <a href="{{ url_for('user_detail', user_id=user.user_id) }}" class="btn btn-primary">View Details</a>
-                  </div>
-                </div>
-              </div>
+              {{ user_card(user) }}
             {% endfor %}
           </div>
+          <template id="user-card-template">
+            {{ user_card({"user_id": "", "mental_percent": "N/A", "risk_category": "N/A", "mental_updated": "", "history": []}) }}
+          </template>
         </div>
         
         <script>
+          // Cohort chart from the cached analytics API; hidden when pandas is not installed.
+          var cohortChart = null;
+          function loadCohorts() {
+              fetch("{{ url_for('analytics_messages') }}?days=30&by=" + document.getElementById('cohort-by').value)
+                  .then(function (response) {
+                      if (!response.ok) { throw new Error(response.status); }
+                      return response.json();
+                  })
+                  .then(function (data) {
+                      if (cohortChart) { cohortChart.destroy(); }
+                      cohortChart = new Chart(document.getElementById('cohortChart').getContext('2d'), {
+                          type: 'line',
+                          data: data,
+                          options: {scales: {y: {beginAtZero: true}}}
+                      });
+                  })
+                  .catch(function () { document.getElementById('cohort-panel').style.display = 'none'; });
+          }
+          document.getElementById('cohort-by').addEventListener('change', loadCohorts);
+          loadCohorts();
+
           // Data for Age Chart
           var ageLabels = {{ age_labels|tojson }};
           var ageCounts = {{ age_counts|tojson }};
           var ctxAge = document.getElementById('ageChart').getContext('2d');
-          new Chart(ctxAge, {
+          var ageChart = new Chart(ctxAge, {
               type: 'pie',
               data: {
                   labels: ageLabels,
@@ -404,7 +277,7 @@ def dashboard():
           var genderLabels = {{ gender_labels|tojson }};
           var genderCounts = {{ gender_counts|tojson }};
           var ctxGender = document.getElementById('genderChart').getContext('2d');
-          new Chart(ctxGender, {
+          var genderChart = new Chart(ctxGender, {
               type: 'pie',
               data: {
                   labels: genderLabels,
@@ -419,7 +292,7 @@ def dashboard():
           var countryLabels = {{ country_labels|tojson }};
           var countryCounts = {{ country_counts|tojson }};
           var ctxCountry = document.getElementById('countryChart').getContext('2d');
-          new Chart(ctxCountry, {
+          var countryChart = new Chart(ctxCountry, {
               type: 'pie',
               data: {
                   labels: countryLabels,
@@ -429,24 +302,120 @@ def dashboard():
                   }]
               }
           });
+
+          // Live feed: patch only the affected card or chart as events arrive.
+          var riskFilter = {{ risk_filter|tojson }};
+          var knownUsers = new Set({{ known_user_ids|tojson }});
+
+          function sparklinePoints(values, width, height) {
+              if (values.length < 2) return '';
+              var step = width / (values.length - 1);
+              return values.map(function (v, i) {
+                  return (i * step).toFixed(1) + ',' + (height - Math.min(Math.max(v || 0, 0), 100) * height / 100).toFixed(1);
+              }).join(' ');
+          }
+
+          function findCard(userId) {
+              return document.querySelector('.user-card[data-user-id="' + userId + '"]');
+          }
+
+          function showAlert(text, userId) {
+              var alert = document.createElement('div');
+              alert.className = 'alert alert-danger d-flex justify-content-between';
+              var link = document.createElement('a');
+              link.href = {{ url_for('user_detail', user_id=0)|tojson }}.replace(/0$/, userId);
+              link.className = 'alert-link';
+              link.textContent = text;
+              var close = document.createElement('button');
+              close.type = 'button';
+              close.className = 'close';
+              close.innerHTML = '&times;';
+              close.onclick = function () { alert.remove(); };
+              alert.appendChild(link);
+              alert.appendChild(close);
+              document.getElementById('alerts').prepend(alert);
+          }
+
+          function bumpChart(chart, label) {
+              var index = chart.data.labels.indexOf(label);
+              if (index === -1) {
+                  chart.data.labels.push(label);
+                  chart.data.datasets[0].data.push(1);
+              } else {
+                  chart.data.datasets[0].data[index] += 1;
+              }
+              chart.update();
+          }
+
+          var feed = new EventSource({{ url_for('event_stream', after=last_event_id)|tojson }});
+
+          feed.addEventListener('risk', function (e) {
+              var ev = JSON.parse(e.data);
+              var card = findCard(ev.user_id);
+              if (card) {
+                  // Replayed events that the page already reflects are skipped.
+                  if (ev.updated_at <= card.dataset.updated) return;
+                  card.dataset.updated = ev.updated_at;
+                  card.querySelector('.mental-percent').textContent = ev.mental_percent;
+                  card.querySelector('.risk-category').textContent = ev.risk_category;
+                  var line = card.querySelector('.sparkline');
+                  var values = JSON.parse(line.dataset.values).concat([ev.mental_percent]).slice(-20);
+                  line.dataset.values = JSON.stringify(values);
+                  line.setAttribute('points', sparklinePoints(values, 120, 30));
+              }
+              if (ev.crossed_red) {
+                  showAlert('User ' + ev.user_id + ' moved into ' + ev.risk_category + ' (' + ev.mental_percent + '%)', ev.user_id);
+                  if (card) card.querySelector('.card').classList.add('border-danger');
+              }
+          });
+
+          feed.addEventListener('message', function (e) {
+              var ev = JSON.parse(e.data);
+              var card = findCard(ev.user_id);
+              if (card) card.querySelector('.last-message').textContent = 'Last message: ' + ev.timestamp;
+          });
+
+          feed.addEventListener('authorization', function (e) {
+              var ev = JSON.parse(e.data);
+              if (knownUsers.has(ev.user_id)) return;
+              knownUsers.add(ev.user_id);
+              bumpChart(ageChart, ev.age);
+              bumpChart(genderChart, ev.gender);
+              bumpChart(countryChart, ev.country);
+              if (riskFilter !== 'All') return;
+              var card = document.getElementById('user-card-template').content.firstElementChild.cloneNode(true);
+              card.dataset.userId = ev.user_id;
+              card.querySelector('.user-id').textContent = ev.user_id;
+              card.querySelector('.age').textContent = ev.age;
+              card.querySelector('.gender').textContent = ev.gender;
+              card.querySelector('.country').textContent = ev.country;
+              var link = card.querySelector('a');
+              link.href = link.getAttribute('href').replace(/0$/, ev.user_id);
+              document.getElementById('user-cards').appendChild(card);
+          });
         </script>
       </body>
     </html>
     """
-    return render_template_string(dashboard_template, users=users,
+    return render_template_string(dashboard_template, users=users, risk_filter=risk_filter,
+                                  known_user_ids=[u[0] for u in auth_users], last_event_id=last_event_id,
                                   age_labels=age_labels, age_counts=age_counts,
                                   gender_labels=gender_labels, gender_counts=gender_counts,
                                   country_labels=country_labels, country_counts=country_counts)
 
 # User detail page: show user's messages, analysis result, and a line chart of message counts per day
-from datetime import datetime, timedelta
-
 @app.route("/user/<int:user_id>")
 def user_detail(user_id):
     user = get_authorization_by_user(user_id)
     messages = get_user_messages(user_id)
     analysis_result, updated_at = get_user_analysis(user_id)
     stats = get_message_stats(user_id)
+    daily_risk = get_daily_risk(user_id)
+    # Imported here so numpy only loads once a detail page is opened.
+    from core import similarity
+    show_similar = similarity.available()
+    # The index is built offline (python -m core.similarity), never inside this request.
+    similar = _with_risk(similarity.similar_users([user_id], 5)[user_id]) if show_similar and similarity.built() else None
     
     # Convert dates to datetime objects and extract counts
     dates = [datetime.strptime(stat[0], '%Y-%m-%d') if isinstance(stat[0], str) else stat[0] for stat in stats]
@@ -499,7 +468,37 @@ def user_detail(user_id):
         <p><em>{{ analysis_result }}</em> {% if updated_at %}<small>(Last updated: {{ updated_at }})</small>{% endif %}</p>
         <a href="{{ url_for('reanalyze', user_id=user[0]) }}" class="btn btn-warning mb-4">Reanalyze</a>
 
-        <h3>Messages per Day</h3>
+        <h3>Risk Trend</h3>
+        {% if daily_risk %}
+            <canvas id="riskTrendChart"></canvas>
+        {% else %}
+            <p>No risk scores recorded yet.</p>
+        {% endif %}
+
+        {% if show_similar %}
+        <h3 class="mt-4">Similar Users</h3>
+        {% if similar is none %}
+            <p>The similarity index is not built yet. Run <code>python -m core.similarity</code> to build it.</p>
+        {% elif similar %}
+            <table class="table table-sm">
+                <thead><tr><th>User</th><th>Similarity</th><th>Mental Health</th><th>Risk</th></tr></thead>
+                <tbody>
+                {% for match in similar %}
+                    <tr>
+                        <td><a href="{{ url_for('user_detail', user_id=match.user_id) }}">{{ match.user_id }}</a></td>
+                        <td>{{ '%.2f'|format(match.score) }}</td>
+                        <td>{% if match.mental_percent is not none %}{{ match.mental_percent }}%{% else %}N/A{% endif %}</td>
+                        <td>{{ match.risk_category or 'N/A' }}</td>
+                    </tr>
+                {% endfor %}
+                </tbody>
+            </table>
+        {% else %}
+            <p>No similar users indexed yet.</p>
+        {% endif %}
+        {% endif %}
+
+        <h3 class="mt-4">Messages per Day</h3>
         <canvas id="messageLineChart"></canvas>
 
         <h3 class="mt-4">User Messages</h3>
@@ -518,6 +517,21 @@ def user_detail(user_id):
         </div>
 
         <script>
+            {% if daily_risk %}
+            new Chart(document.getElementById('riskTrendChart').getContext('2d'), {
+                type: 'line',
+                data: {
+                    labels: {{ daily_risk|map(attribute=0)|list|tojson }},
+                    datasets: [
+                        {label: 'Max', data: {{ daily_risk|map(attribute=3)|list|tojson }}, borderColor: '#dc3545', fill: false},
+                        {label: 'Average', data: {{ daily_risk|map(attribute=2)|list|tojson }}, borderColor: '#FFCE56', fill: false},
+                        {label: 'Min', data: {{ daily_risk|map(attribute=1)|list|tojson }}, borderColor: '#66BB6A', fill: false}
+                    ]
+                },
+                options: {scales: {y: {min: 0, max: 100, title: {display: true, text: 'Risk %'}}}}
+            });
+            {% endif %}
+
             var dateLabels = {{ date_labels|safe }};
             var recordCounts = {{ record_counts|safe }};
 
@@ -562,15 +576,278 @@ def user_detail(user_id):
     """
     return render_template_string(user_detail_template, user=user, messages=messages,
                                   analysis_result=analysis_result, updated_at=updated_at,
-                                  date_labels=date_labels, record_counts=record_counts)
+                                  date_labels=date_labels, record_counts=record_counts,
+                                  daily_risk=daily_risk, similar=similar, show_similar=show_similar)
+
+def _json(payload, status: int = 200) -> Response:
+    return Response(json.dumps(payload), status=status, mimetype="application/json")
+
+def _with_risk(matches) -> list:
+    """Attach each matched user's latest mental health score to (user_id, score) pairs."""
+    results = []
+    for user_id, score in matches:
+        mental_percent, risk_category, _ = get_user_mental_health(user_id)
+        results.append({"user_id": user_id, "score": round(score, 4),
+                        "mental_percent": mental_percent, "risk_category": risk_category})
+    return results
+
+# Similar-case retrieval over the local embedding index (core/similarity.py)
+@app.route("/api/users/<int:user_id>/similar")
+def similar_users_json(user_id):
+    from core import similarity
+    if not similarity.available():
+        return _json({"error": "numpy is not installed"}, 503)
+    if not similarity.built():
+        return _json({"error": "similarity index not built; run python -m core.similarity"}, 503)
+    k = min(max(request.args.get("k", 10, type=int), 1), 100)
+    matches = similarity.similar_users([user_id], k)[user_id]
+    return _json({"user_id": user_id, "similar": _with_risk(matches)})
+
+@app.route("/api/users/search")
+def search_users_json():
+    from core import similarity
+    if not similarity.available():
+        return _json({"error": "numpy is not installed"}, 503)
+    if not similarity.built():
+        return _json({"error": "similarity index not built; run python -m core.similarity"}, 503)
+    query = request.args.get("q", "").strip()
+    if not query:
+        return _json({"error": "q is required"}, 400)
+    k = min(max(request.args.get("k", 10, type=int), 1), 100)
+    matches = similarity.search_users(query, k)
+    return _json({"query": query, "users": _with_risk(matches)})
+
+# Cohort analytics from the cached frames in core/analytics.py, shaped for Chart.js
+def _analytics_query(compute):
+    from core import analytics
+    if not analytics.available():
+        return _json({"error": "pandas is not installed"}, 503)
+    days = min(max(request.args.get("days", 30, type=int), 1), 3650)
+    try:
+        return _json(compute(analytics, days))
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+
+@app.route("/api/analytics/messages")
+def analytics_messages():
+    by = request.args.get("by", "country")
+    return _analytics_query(lambda analytics, days: analytics.messages_per_day(by, days))
+
+@app.route("/api/analytics/cohorts")
+def analytics_cohorts():
+    by = request.args.get("by", "country")
+    return _analytics_query(lambda analytics, days: analytics.cohort_summary(by, days))
+
+@app.route("/api/analytics/users/<int:user_id>/messages")
+def analytics_user_messages(user_id):
+    whole_span = "days" not in request.args
+    return _analytics_query(lambda analytics, days: analytics.user_daily_messages(user_id, None if whole_span else days))
+
+# Users whose recent risk scores rose well above their earlier ones (DeterioratingUsers view)
+@app.route("/deteriorating")
+def deteriorating_users():
+    rows = get_deteriorating_users()
+    histories = get_risk_histories([row[0] for row in rows])
+    deteriorating_template = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Deteriorating Users</title>
+        <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/css/bootstrap.min.css">
+    </head>
+    <body>
+        <div class="container mt-4">
+        <a href="{{ url_for('dashboard') }}" class="btn btn-secondary mb-3">Back to Dashboard</a>
+        <h2>Deteriorating Users</h2>
+        <p>Average of the last 3 risk scores at least 10 points above the average of the 7 before them.</p>
+        {% if rows %}
+        <table class="table table-sm table-striped">
+            <thead>
+            <tr><th>User ID</th><th>Recent avg</th><th>Previous avg</th><th>Change</th><th>Category</th><th>Trend</th><th>Last scored</th></tr>
+            </thead>
+            <tbody>
+            {% for user_id, recent_avg, previous_avg, delta, risk_category, last_recorded_at in rows %}
+            <tr>
+                <td><a href="{{ url_for('user_detail', user_id=user_id) }}">{{ user_id }}</a></td>
+                <td>{{ "%.1f"|format(recent_avg) }}%</td>
+                <td>{{ "%.1f"|format(previous_avg) }}%</td>
+                <td class="text-danger">+{{ "%.1f"|format(delta) }}</td>
+                <td>{{ risk_category }}</td>
+                <td><svg width="120" height="30"><polyline points="{{ sparkline_points(histories[user_id]) }}" fill="none" stroke="#dc3545" stroke-width="1.5"/></svg></td>
+                <td><small>{{ last_recorded_at }}</small></td>
+            </tr>
+            {% endfor %}
+            </tbody>
+        </table>
+        {% else %}
+            <p>No user's risk is currently rising.</p>
+        {% endif %}
+        </div>
+    </body>
+    </html>
+    """
+    return render_template_string(deteriorating_template, rows=rows, histories=histories,
+                                  sparkline_points=sparkline_points)
+
+# LLM usage: daily, per-call-type and per-user rollups of tokens, latency and cost, with today's budget
+@app.route("/usage")
+def llm_usage():
+    days = request.args.get("days", 30, type=int)
+    usage_template = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>LLM Usage</title>
+        <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/css/bootstrap.min.css">
+    </head>
+    <body>
+        <div class="container-fluid mt-4">
+        <a href="{{ url_for('dashboard') }}" class="btn btn-secondary mb-3">Back to Dashboard</a>
+        <h2>LLM Usage <small class="text-muted">last {{ days }} days</small></h2>
+
+        <h4 class="mt-4">Today's Budget</h4>
+        {% if budget %}
+        <table class="table table-sm" style="max-width: 600px;">
+            <thead><tr><th>Limit</th><th>Used</th><th>Limit</th><th>%</th></tr></thead>
+            <tbody>
+            {% for name, used, limit in budget %}
+            <tr class="{% if used >= limit %}table-danger{% elif used >= limit * downgrade_at %}table-warning{% endif %}">
+                <td>{{ name }}</td><td>{{ "%.4g"|format(used) }}</td><td>{{ limit }}</td>
+                <td>{{ "%.0f"|format(100 * used / limit) }}</td>
+            </tr>
+            {% endfor %}
+            </tbody>
+        </table>
+        {% else %}
+            <p>No daily budget configured (<code>llm_budget</code> in config.json).</p>
+        {% endif %}
+
+        <h4 class="mt-4">By Day</h4>
+        <table class="table table-sm table-striped">
+            <thead><tr><th>Day</th><th>Calls</th><th>Prompt tokens</th><th>Completion tokens</th>
+                       <th>Cost (USD)</th><th>Avg latency ms</th><th>Errors</th><th>Skipped</th></tr></thead>
+            <tbody>
+            {% for day, calls, prompt, completion, cost, latency, errors, skipped in daily %}
+            <tr><td>{{ day }}</td><td>{{ calls }}</td><td>{{ prompt }}</td><td>{{ completion }}</td>
+                <td>{{ "%.4f"|format(cost or 0) }}</td><td>{{ "%.0f"|format(latency or 0) }}</td>
+                <td>{{ errors }}</td><td>{{ skipped }}</td></tr>
+            {% endfor %}
+            </tbody>
+        </table>
+
+        <h4 class="mt-4">By Call Type</h4>
+        <table class="table table-sm table-striped">
+            <thead><tr><th>Call</th><th>Model</th><th>Calls</th><th>Prompt tokens</th><th>Completion tokens</th>
+                       <th>Cost (USD)</th><th>Avg latency ms</th><th>Max latency ms</th></tr></thead>
+            <tbody>
+            {% for call_type, model, calls, prompt, completion, cost, avg_latency, max_latency in calls %}
+            <tr><td>{{ call_type }}</td><td>{{ model }}</td><td>{{ calls }}</td><td>{{ prompt }}</td>
+                <td>{{ completion }}</td><td>{{ "%.4f"|format(cost or 0) }}</td>
+                <td>{{ "%.0f"|format(avg_latency or 0) }}</td><td>{{ "%.0f"|format(max_latency or 0) }}</td></tr>
+            {% endfor %}
+            </tbody>
+        </table>
+
+        <h4 class="mt-4">Reply Latency</h4>
+        {% if replies %}
+        <table class="table table-sm table-striped" style="max-width: 800px;">
+            <thead><tr><th>Mode</th><th>Replies</th><th>Avg time to first text ms</th>
+                       <th>Avg full reply ms</th><th>Avg edits</th></tr></thead>
+            <tbody>
+            {% for streamed, count, ttft, latency, edits in replies %}
+            <tr><td>{{ "Streamed" if streamed else "Single message" }}</td><td>{{ count }}</td>
+                <td>{{ "%.0f"|format(ttft) }}</td><td>{{ "%.0f"|format(latency) }}</td><td>{{ "%.1f"|format(edits) }}</td></tr>
+            {% endfor %}
+            </tbody>
+        </table>
+        {% else %}
+            <p>No replies recorded yet.</p>
+        {% endif %}
+
+        <h4 class="mt-4">Top Users</h4>
+        <table class="table table-sm table-striped">
+            <thead><tr><th>User ID</th><th>Calls</th><th>Tokens</th><th>Tokens today</th>
+                       <th>Cost (USD)</th><th>Avg latency ms</th></tr></thead>
+            <tbody>
+            {% for user_id, calls, tokens, tokens_today, cost, latency in users %}
+            <tr>
+                <td>{% if user_id is not none %}<a href="{{ url_for('user_detail', user_id=user_id) }}">{{ user_id }}</a>{% else %}-{% endif %}</td>
+                <td>{{ calls }}</td><td>{{ tokens }}</td><td>{{ tokens_today }}</td>
+                <td>{{ "%.4f"|format(cost or 0) }}</td><td>{{ "%.0f"|format(latency or 0) }}</td>
+            </tr>
+            {% endfor %}
+            </tbody>
+        </table>
+        </div>
+    </body>
+    </html>
+    """
+    budget_config = get_config().get("llm_budget") or {}
+    return render_template_string(usage_template, days=days,
+                                  budget=usage.budget_usage(), downgrade_at=budget_config.get("downgrade_at", 0.8),
+                                  daily=usage.daily_rollup(days), calls=usage.call_rollup(days),
+                                  users=usage.user_rollup(days), replies=get_reply_latency(days))
+
 # Endpoint to re-run analysis for a given user
 @app.route("/user/<int:user_id>/reanalyze")
 def reanalyze(user_id):
-    user_history = get_user_history(user_id)
-    success, explanation = analyze_user_messages(user_history)
+    user_history = get_user_history(user_id, timestamps=True)
+    success, explanation = analyze_user_messages(user_history, user_id=user_id)
     analysis_text = ("Concern detected: " + explanation) if success else ("No concern detected: " + explanation)
     update_user_analysis(user_id, analysis_text)
     return redirect(url_for('user_detail', user_id=user_id))
 
+# Admin page: SQL statements aggregated by fingerprint, slowest first
+@app.route("/admin/queries")
+def admin_queries():
+    queries = query_profiler.PROFILER.report()
+    queries_template = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Query Profile</title>
+        <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/css/bootstrap.min.css">
+    </head>
+    <body>
+        <div class="container-fluid mt-4">
+        <a href="{{ url_for('dashboard') }}" class="btn btn-secondary mb-3">Back to Dashboard</a>
+        <a href="{{ url_for('admin_queries_json') }}" class="btn btn-outline-primary mb-3">Download JSON</a>
+        <h2>Query Profile</h2>
+        <p>Plans are captured for statements slower than {{ slow_ms }} ms.
+           "Max / request" shows how often one statement repeated inside a single request (N+1 pattern).</p>
+        <table class="table table-sm table-striped">
+            <thead>
+            <tr>
+                <th>Statement</th><th>Calls</th><th>Total ms</th><th>Avg ms</th><th>Max ms</th>
+                <th>Slow</th><th>Max / request</th><th>Query plan</th>
+            </tr>
+            </thead>
+            <tbody>
+            {% for q in queries %}
+            <tr class="{% if q.full_scan %}table-danger{% elif q.max_per_scope > 10 %}table-warning{% endif %}">
+                <td><code>{{ q.fingerprint }}</code></td>
+                <td>{{ q.calls }}</td>
+                <td>{{ "%.1f"|format(q.total_ms) }}</td>
+                <td>{{ "%.2f"|format(q.avg_ms) }}</td>
+                <td>{{ "%.1f"|format(q.max_ms) }}</td>
+                <td>{{ q.slow_calls }}</td>
+                <td>{{ q.max_per_scope }}{% if q.max_scope %} <small class="text-muted">({{ q.max_scope }})</small>{% endif %}</td>
+                <td>{% if q.plan %}<small>{{ q.plan|join("<br>"|safe) }}</small>{% endif %}</td>
+            </tr>
+            {% endfor %}
+            </tbody>
+        </table>
+        </div>
+    </body>
+    </html>
+    """
+    return render_template_string(queries_template, queries=queries,
+                                  slow_ms=query_profiler.PROFILER.slow_ms)
+
+@app.route("/admin/queries.json")
+def admin_queries_json():
+    return Response(query_profiler.PROFILER.dump_json(), mimetype="application/json")
+
 if __name__ == '__main__':
+    init_db()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,96 @@
+"""
+Startup benchmark for the two entry points.
+
+Each run starts a fresh interpreter in a scratch directory holding copies of
+config.json, promt.txt and telegram_bot.db, and measures:
+
+- app: `import app`, then the first dashboard request (GET / via the Flask test client);
+- bot: `import bot_mentalx`, then `build_application()` plus the first DB helper call.
+
+Pass `--tree` to measure another checkout (e.g. a `git worktree` of an older
+commit) with the same data:
+
+    python bench_startup.py --runs 10
+    python bench_startup.py --tree /tmp/analyzebot-old
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+DATA_FILES = ('config.json', 'promt.txt', 'telegram_bot.db')
+
+PROBES = {
+    "app": '''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+status = app.app.test_client().get("/").status_code
+finished = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "first_request_ms": (finished - imported) * 1000,
+                  "status": status}))
+''',
+    "bot": '''
+import json, time
+started = time.perf_counter()
+import bot_mentalx
+imported = time.perf_counter()
+bot_mentalx.build_application()
+bot_mentalx.get_user_history(0)
+finished = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "first_request_ms": (finished - imported) * 1000,
+                  "status": "ok"}))
+''',
+}
+
+# Creates the schema without timing it; works for trees with and without core/.
+SETUP = "import bot_mentalx; bot_mentalx.init_db()"
+
+
+def _run(code: str, tree: str, workdir: str) -> str:
+    env = dict(os.environ, PYTHONPATH=tree)
+    result = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ""
+
+
+def benchmark(tree: str, data_dir: str, runs: int) -> dict:
+    """Return median import and first-request latency (ms) per entry point."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="analyzebot-bench-") as workdir:
+        for name in DATA_FILES:
+            if os.path.exists(os.path.join(data_dir, name)):
+                shutil.copy(os.path.join(data_dir, name), workdir)
+        _run(SETUP, tree, workdir)
+        for entry, probe in PROBES.items():
+            samples = [json.loads(_run(probe, tree, workdir)) for _ in range(runs)]
+            results[entry] = {
+                "import_ms": round(statistics.median(s["import_ms"] for s in samples), 1),
+                "first_request_ms": round(statistics.median(s["first_request_ms"] for s in samples), 1),
+                "status": samples[-1]["status"],
+            }
+    return results
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Measure import and first-request latency of app.py and bot_mentalx.py")
+    parser.add_argument('--tree', default=here, help="checkout to benchmark (default: this one)")
+    parser.add_argument('--data', default=here, help="directory holding config.json, promt.txt and telegram_bot.db")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = benchmark(os.path.abspath(args.tree), args.data, args.runs)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'entry':<6} {'import ms':>10} {'first request ms':>17} {'total ms':>9}  status")
+        for entry, r in results.items():
+            print(f"{entry:<6} {r['import_ms']:>10} {r['first_request_ms']:>17} "
+                  f"{round(r['import_ms'] + r['first_request_ms'], 1):>9}  {r['status']}")
@@ -1,9 +1,8 @@
-import os
-import sqlite3
+import argparse
+import asyncio
 import logging
-import json
-import re
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
 from telegram import ReplyKeyboardMarkup , ReplyKeyboardRemove
 from telegram.ext import (
 
@@ -14,320 +13,37 @@ from telegram.ext import (
     ConversationHandler,
     
 )
-from openai import OpenAI
 
+import metrics
+import query_profiler
+import reply_stream
+import retention
+import storage
+from concurrency import PerUserUpdateProcessor
+from core import usage
+from core.config import get_config
+from core.db import (
+    init_db,
+    insert_authorization,
+    insert_chat,
+    insert_message,
+    insert_reply,
+    get_user_history,
+    update_user_analysis,
+    update_user_mental_health,
+)
+from core.llm import analyze_user_messages, get_ai_response, get_mental_health_percentage, stream_ai_response
+from ingress import DROP, STORE_ONLY, IngressGate
+from persistence import DEFAULT_TTL, SQLitePersistence
 
-# Load configuration
-with open('config.json', 'r') as file:
-    data = json.load(file)
 
 # --- Global Configuration & Globals ---
-with open('config.json', 'r') as file:
-    data = json.load(file)
-DB_FILE = 'telegram_bot.db'
-client = OpenAI(api_key=data['openai_api_key'])
+# config.json, the OpenAI client and the database are opened on first use (see core/).
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# --- Database Initialization and Helper Functions ---
-
-def init_db():
-    """Initialize the SQLite database with required tables."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    # Chats table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER UNIQUE,
-            chat_name TEXT,
-            created_at TEXT
-        )
-    ''')
-    # Messages table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER,
-            user_id INTEGER,
-            content TEXT,
-            timestamp TEXT,
-            FOREIGN KEY (chat_id) REFERENCES Chats(chat_id)
-        )
-    ''')
-    # Analyses table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Analyses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            analysis_result TEXT,
-            updated_at TEXT
-        )
-    ''')
-    # MessageStats table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS MessageStats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            date TEXT,  
-            message_count INTEGER,
-            UNIQUE(user_id, date)
-        )
-    ''')
-    # Authorizations table for storing authorization data
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Authorizations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            age TEXT,
-            gender TEXT,
-            country TEXT,
-            created_at TEXT
-        )
-    ''')
-    # New table for storing mental health risk percentage and risk category
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS UserMentalHealth (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            mental_percent REAL,
-            risk_category TEXT,
-            updated_at TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
-def is_valid_input(user_input):
-    # Define the regular expression pattern
-    pattern = r'^[A-Za-z\u0400-\u04FF0-9\s\|\]\[\+=\-@#.,!?;:()\'\"—]+$'
-    # Match the pattern against the user input
-    return bool(re.match(pattern, user_input))
-async def validate_input(update, context):
-    user_message = update.message.text
-    if not is_valid_input(user_message):
-        await update.message.reply_text("Invalid input. Please use only permitted characters.")
-        return
-    else:
-        await message_handler(update, context)
-def insert_chat(chat):
-    """Insert chat info into the Chats table if not already present."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT chat_id FROM Chats WHERE chat_id = ?', (chat.id,))
-    if cursor.fetchone() is None:
-        chat_name = getattr(chat, 'title', None)
-        cursor.execute(
-            'INSERT INTO Chats (chat_id, chat_name, created_at) VALUES (?, ?, ?)',
-            (chat.id, chat_name, datetime.now().isoformat())
-        )
-        conn.commit()
-    conn.close()
-
-def insert_message(chat, user, content):
-    """Insert a new message into the Messages table and update daily stats."""
-    now = datetime.now()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        'INSERT INTO Messages (chat_id, user_id, content, timestamp) VALUES (?, ?, ?, ?)',
-        (chat.id, user.id, content, now.isoformat())
-    )
-    current_date = now.date().isoformat()
-    cursor.execute('''
-        INSERT INTO MessageStats (user_id, date, message_count)
-        VALUES (?, ?, 1)
-        ON CONFLICT(user_id, date) DO UPDATE SET message_count = message_count + 1
-    ''', (user.id, current_date))
-    conn.commit()
-    conn.close()
-
-def analyze_user_messages(user_history: str, window_size: int = 10) -> (bool, str):
-    messages_list = [msg.strip() for msg in user_history.split("\n") if msg.strip()]
-    if len(" ".join(messages_list).split()) < 50:
-        return (False, "Not enough data for analysis.")
-    recent_history = "\n".join(messages_list[-window_size:])
-    prompt = (
-        "Analyze the following user's conversation history for signs of psychological distress or indicators that "
-        "the user might benefit from psychological analysis. Give extra weight to the most recent messages. If the most recent "
-        "messages indicate improvement or resolution of previous issues, reflect that in your analysis. Respond with either:\n"
-        "'yes: <brief explanation>' if concern is detected, or\n"
-        "'no: <brief explanation>' if no concern is detected.\n\n"
-        "Recent conversation history:\n" + recent_history
-    )
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Analyzing user conversation history."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=100
-    )
-    result = response.choices[0].message.content.strip().lower()
-    if result.startswith("yes:"):
-        explanation = result[4:].strip()
-        return (True, explanation)
-    return (False, result[3:].strip() if result.startswith("no:") else result)
-
-async def message_handler(update, context):
-    chat = update.message.chat
-    user = update.message.from_user
-    message_text = update.message.text
-
-    insert_chat(chat)
-    insert_message(chat, user, message_text)
-    
-    history = get_user_history(user.id)
-    needs_analysis, explanation = analyze_user_messages(history)  # This call must find the function
-    analysis_text = ("Concern detected: " + explanation) if needs_analysis else ("No concern detected: " + explanation)
-    update_user_analysis(user.id, analysis_text)
-    logger.info(f"User {user.id} analysis updated: {analysis_text}")
-    
-    ai_reply = get_ai_response(message_text)
-    await update.message.reply_text(ai_reply)
-
-def update_user_analysis(user_id: int, analysis_result: str):
-    """Insert or update the analysis result for a given user in the Analyses table."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    now = datetime.now().isoformat()
-    cursor.execute('''
-        INSERT OR REPLACE INTO Analyses (id, user_id, analysis_result, updated_at)
-        VALUES (
-            (SELECT id FROM Analyses WHERE user_id = ?),
-            ?, ?, ?
-        )
-    ''', (user_id, user_id, analysis_result, now))
-    conn.commit()
-    conn.close()
-
-def get_user_history(user_id: int) -> str:
-    """Retrieve and combine all messages of a given user ordered by time."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT content FROM Messages 
-        WHERE user_id = ? 
-        ORDER BY timestamp
-    ''', (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    return "\n".join(message for (message,) in rows)
-
-def get_all_users() -> list:
-    """Retrieve a list of distinct user IDs from the Messages table."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT user_id FROM Messages ORDER BY user_id')
-    users = cursor.fetchall()
-    conn.close()
-    return [u[0] for u in users]
-
-def get_user_analysis(user_id: int) -> str:
-    """Retrieve the latest analysis result for a given user from the Analyses table."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT analysis_result, updated_at FROM Analyses WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return f"Last updated at {row[1]}: {row[0]}"
-    else:
-        return "No analysis available."
-
-def get_message_stats(user_id: int) -> list:
-    """Retrieve daily message statistics for a given user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT date, message_count FROM MessageStats
-        WHERE user_id = ?
-        ORDER BY date DESC
-    ''', (user_id,))
-    stats = cursor.fetchall()
-    conn.close()
-    return stats
-
-def insert_authorization(user_id: int, age: str, gender: str, country: str):
-    """Insert or update authorization data for a given user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    now = datetime.now().isoformat()
-    cursor.execute('''
-        INSERT OR REPLACE INTO Authorizations (user_id, age, gender, country, created_at)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, age, gender, country, now))
-    conn.commit()
-    conn.close()
-
-def update_user_mental_health(user_id: int, mental_percent: float, risk_category: str):
-    """Insert or update the mental health risk percentage for a given user."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    now = datetime.now().isoformat()
-    cursor.execute('''
-        INSERT OR REPLACE INTO UserMentalHealth (user_id, mental_percent, risk_category, updated_at)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, mental_percent, risk_category, now))
-    conn.commit()
-    conn.close()
-
-# --- New Analysis Function for Mental Health Risk Percentage ---
-
-def get_mental_health_percentage(user_history: str) -> (float, str):
-    """
-    Use OpenAI's API to get a mental health risk percentage (0-100) based on the user's conversation history.
-    Expected output format: "NUMBER: CATEGORY" (e.g., "15: Green").
-    """
-    messages_list = [msg.strip() for msg in user_history.split("\n") if msg.strip()]
-    # If not enough data, default to 0%
-    if len(" ".join(messages_list).split()) < 50:
-        return (0.0, "Green")
-    
-    recent_history = "\n".join(messages_list[-10:])
-    prompt = (
-        "Based on the following user's conversation history, provide a mental health risk percentage from 0 to 100. "
-        "0 means the user is completely okay, and 100 means extremely high risk. Then, assign a risk category as follows: "
-        "0-20: Green - you are okay, 20-40: Orange - a little problem, 40-60: Yellow - moderate concern, above 60: Red - immediate help needed. "
-        "Output your answer in the format: NUMBER: CATEGORY. For example, '15: Green'.\n\n"
-        "Conversation history:\n" + recent_history
-    )
-    
-    response = client.chat.completions.create(
-         model="gpt-3.5-turbo",
-         messages=[
-              {"role": "system", "content": "Analyze mental health risk."},
-              {"role": "user", "content": prompt}
-         ],
-         max_tokens=50
-    )
-    result = response.choices[0].message.content.strip()
-    try:
-         parts = result.split(":")
-         percent = float(parts[0].strip())
-         category = parts[1].strip() if len(parts) > 1 else ""
-         return (percent, category)
-    except Exception as e:
-         logger.error(f"Error parsing mental health analysis: {e}. Response was: {result}")
-         return (0.0, "Green")
-
-# --- OpenAI GPT Agent Functions for Conversational Replies ---
-
-def get_ai_response(user_message: str) -> str:
-    """Generate a conversational reply using GPT-3.5-turbo."""
-    with open("promt.txt", "r") as f:
-        system_prompt = f.read()
-    messages = [
-       {"role": "system", "content": system_prompt},
-       {"role": "user", "content": user_message}
-    ]
-    response = client.chat.completions.create(
-         model="gpt-3.5-turbo",
-         messages=messages,
-         max_tokens=150,
-         temperature=0.7,
-         top_p=1
-    )
-    return response.choices[0].message.content.strip()
+# Messages read for each analysis: more than its window, and no more than retention keeps in the hot table.
+ANALYSIS_HISTORY = 50
 
 # --- Authorization Conversation Handlers ---
 # Define conversation states.
@@ -385,12 +101,15 @@ async def handle_country(update, context):
     context.user_data['country'] = country
     # Insert authorization data into your database or storage here
     await update.message.reply_text("Authorization completed. Thank you!", reply_markup=ReplyKeyboardRemove())
-    insert_authorization(user_id, **context.user_data)
+    insert_authorization(user_id, context.user_data['age'], context.user_data['gender'], country)
+    # The answers now live in Authorizations; drop the partial copy kept for the flow.
+    context.user_data.clear()
     return ConversationHandler.END
 
 
 async def cancel(update, context):
     """Handle the cancellation of the conversation."""
+    context.user_data.clear()
     await update.message.reply_text("Authorization process has been cancelled.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
@@ -401,32 +120,133 @@ async def message_handler(update, context):
     user = update.message.from_user
     message_text = update.message.text
 
-    insert_chat(chat)
-    insert_message(chat, user, message_text)
-    
-    history = get_user_history(user.id)
-    needs_analysis, explanation = analyze_user_messages(history)
-    analysis_text = ("Concern detected: " + explanation) if needs_analysis else ("No concern detected: " + explanation)
-    update_user_analysis(user.id, analysis_text)
-    logger.info(f"User {user.id} analysis updated: {analysis_text}")
-    
-    # Compute mental health percentage and update in the new table.
-    mental_percent, risk_category = get_mental_health_percentage(history)
-    update_user_mental_health(user.id, mental_percent, risk_category)
-    logger.info(f"User {user.id} mental health risk: {mental_percent}% ({risk_category})")
-    
-    ai_reply = get_ai_response(message_text)
-    await update.message.reply_text(ai_reply)
+    metrics.add_gauge("analyzebot_bot_inflight_updates", 1)
+    try:
+        with metrics.span("handler.message"):
+            # SQLite and OpenAI calls block, so they run in the worker thread pool
+            # while other users' updates keep progressing on the event loop.
+            await asyncio.to_thread(insert_chat, chat)
+            await asyncio.to_thread(insert_message, chat, user, message_text)
+
+            # A streamed reply starts now and runs alongside the analysis; the reply does not depend on it.
+            streaming = context.bot_data['reply_streaming']
+            streamed_reply = None
+            if streaming['enabled']:
+                streamed_reply = asyncio.create_task(send_streamed_reply(update.message, message_text, streaming))
+
+            try:
+                # Background analysis follows the daily LLM budget; the reply always runs.
+                budget = await asyncio.to_thread(usage.budget_mode, user.id)
+                if budget == usage.SKIP:
+                    usage.record_skipped(user.id, "analysis")
+                    usage.record_skipped(user.id, "mental_health")
+                    logger.info(f"User {user.id}: daily LLM budget exhausted, analysis skipped")
+                else:
+                    options = usage.downgrade_options() if budget == usage.DOWNGRADE else {}
+                    history = await asyncio.to_thread(get_user_history, user.id, limit=ANALYSIS_HISTORY)
+                    needs_analysis, explanation = await asyncio.to_thread(
+                        analyze_user_messages, history, user_id=user.id, **options)
+                    analysis_text = ("Concern detected: " + explanation) if needs_analysis else ("No concern detected: " + explanation)
+                    await asyncio.to_thread(update_user_analysis, user.id, analysis_text)
+                    logger.info(f"User {user.id} analysis updated: {analysis_text}")
+
+                    await asyncio.to_thread(update_risk_score, user.id, history, **options)
+            finally:
+                if streamed_reply is not None:
+                    await streamed_reply
+
+            if streamed_reply is None:
+                started = time.perf_counter()
+                ai_reply = await asyncio.to_thread(get_ai_response, message_text, user_id=user.id)
+                latency_ms = (time.perf_counter() - started) * 1000
+                with metrics.span("telegram.reply_text"):
+                    await update.message.reply_text(ai_reply)
+                await asyncio.to_thread(insert_reply, user.id, chat.id, ai_reply, False, latency_ms, latency_ms)
+    finally:
+        metrics.add_gauge("analyzebot_bot_inflight_updates", -1)
+
+def update_risk_score(user_id: int, history: str, **options):
+    """Score the history and store it; without a score (too little history) nothing is written or published."""
+    score = get_mental_health_percentage(history, user_id=user_id, **options)
+    if score is None:
+        logger.info(f"User {user_id}: no mental health score yet")
+        return None
+    mental_percent, risk_category = score
+    update_user_mental_health(user_id, mental_percent, risk_category)
+    logger.info(f"User {user_id} mental health risk: {mental_percent}% ({risk_category})")
+    return score
+
+async def send_streamed_reply(message, message_text, options):
+    """Stream the AI reply into a placeholder message and store the final text (see reply_stream.py)."""
+    user_id = message.from_user.id
+    with metrics.span("telegram.streamed_reply"):
+        reply = await reply_stream.stream_reply(message, stream_ai_response(message_text, user_id=user_id), options)
+    if not reply["text"]:
+        logger.warning(f"User {user_id}: the reply completion was empty")
+        return
+    await asyncio.to_thread(insert_reply, user_id, message.chat.id, reply["text"], True,
+                            reply["ttft_ms"], reply["latency_ms"], reply["edits"])
+
+# --- Ingress Stage ---
+async def ingress_handler(update, context):
+    """Apply character, flood and duplicate rules before any DB or LLM work is done."""
+    user = update.message.from_user
+    action, rule = context.bot_data['ingress'].check(user.id, update.message.text)
+    if action == DROP:
+        if rule == "invalid":
+            await update.message.reply_text("Invalid input. Please use only permitted characters.")
+        return
+    if action == STORE_ONLY:
+        await asyncio.to_thread(insert_chat, update.message.chat)
+        await asyncio.to_thread(insert_message, update.message.chat, user, update.message.text)
+        return
+    await message_handler(update, context)
 
 # --- Main Application Setup ---
-def main():
-    # Initialize the database.
-    init_db()
-    
-    # Create the Application and add handlers.
-    application = Application.builder().token(data['telegram_bot_token']).build()
-    # validation_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, validate_input)
-    # application.add_handler(validation_handler, group=0)
+async def post_init(application):
+    """Size the handler thread pool and start the background eviction and retention tasks.
+
+    Webhook workers set bot_data['run_retention'] to False; the receiver runs the schedule once instead.
+    """
+    config = get_config()
+    workers = application.update_processor.max_active_updates
+    if application.bot_data['reply_streaming']['enabled']:
+        # A streamed reply holds a thread for its whole completion while the analysis uses another.
+        workers *= 2
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=workers, thread_name_prefix="handler"))
+    application.bot_data['eviction_task'] = loop.create_task(
+        application.persistence.run_eviction(application, config.get('persistence_sweep_interval', 600)))
+    if 'retention' in config and application.bot_data.get('run_retention', True):
+        application.bot_data['retention_task'] = loop.create_task(
+            retention.run_periodically(retention.load_policy(config)))
+
+def build_application(request=None, get_updates_request=None):
+    """Create the Application and register the authorization and message handlers.
+
+    `request`/`get_updates_request` replace the HTTP transport to the Bot API (webhook replay passes offline ones).
+    """
+    config = get_config()
+    # Different users are handled concurrently; each user's updates stay strictly ordered.
+    update_processor = PerUserUpdateProcessor(
+        config.get('concurrent_updates', 16),
+        max_pending_updates=config.get('max_pending_updates'),
+    )
+    builder = Application.builder().token(config['telegram_bot_token'])
+    if request is not None:
+        builder = builder.request(request).get_updates_request(get_updates_request)
+    application = (
+        builder
+        .concurrent_updates(update_processor)
+        .persistence(SQLitePersistence(
+            ttl=config.get('conversation_ttl', DEFAULT_TTL),
+            update_interval=config.get('persistence_interval', 5),
+        ))
+        .post_init(post_init)
+        .build()
+    )
+    application.bot_data['ingress'] = IngressGate(config.get('ingress'))
+    application.bot_data['reply_streaming'] = reply_stream.load_options(config)
 
     # Authorization conversation handler using /start as the entry point.
     auth_conv_handler = ConversationHandler(
@@ -436,15 +256,56 @@ def main():
             GENDER: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_gender)],
             COUNTRY: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_country)]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='authorization',
+        persistent=True,
     )
     
-    # Add the conversation handler and the general message handler.
+    # Add the conversation handler and the general message handler behind the ingress rules.
     application.add_handler(auth_conv_handler)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, ingress_handler))
+
+    metrics.describe("analyzebot_bot_update_queue_depth", "Telegram updates waiting to be dispatched.")
+    metrics.describe("analyzebot_bot_inflight_updates", "Messages currently inside message_handler.")
+    metrics.gauge_callback("analyzebot_bot_update_queue_depth", application.update_queue.qsize)
+    return application
+
+def main():
+    config = get_config()
+    parser = argparse.ArgumentParser(description="MentalX Telegram bot")
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default=config.get('mode', 'polling'))
+    parser.add_argument('--workers', type=int, default=config.get('webhook_workers', 2),
+                        help="number of worker processes in webhook mode")
+    parser.add_argument('--replay', metavar='UPDATES_JSONL',
+                        help="feed recorded updates to the webhook workers instead of listening")
+    parser.add_argument('--migrate-shards', action='store_true',
+                        help="move rows from telegram_bot.db into the configured shard files and exit")
+    args = parser.parse_args()
+
+    # Initialize the database.
+    init_db()
+
+    if args.migrate_shards:
+        moved = storage.migrate_to_shards(storage.backend())
+        logger.info(f"Moved rows into shards: {moved}")
+        return
+
+    if args.mode == 'webhook' or args.replay:
+        import webhook
+        webhook.run(config, workers=args.workers, replay_path=args.replay)
+        return
+
+    application = build_application()
+
+    # Expose /metrics for the bot process on a side port.
+    metrics.start_http_server(config.get('metrics_port', 9108))
     
     # Start the bot.
     application.run_polling()
 
+    # Keep the SQL profile of this run for offline inspection.
+    if config.get('query_profile_path'):
+        query_profiler.PROFILER.dump_json(config['query_profile_path'])
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
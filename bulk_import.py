@@ -0,0 +1,316 @@
+"""
+Bulk import of legacy message exports and backfills.
+
+Supported formats (detected from the file, or forced with --format):
+
+* chat_data.csv  - no header: timestamp,user_id,username,text
+* output.csv     - header id,chat_id,user_id,content,timestamp (a Messages dump)
+* chat_data.txt  - one "Chat ID N: text" line per message; lines without the
+                   prefix continue the previous message. The file has no
+                   timestamps, so every message gets --timestamp (default: the
+                   file's modification time).
+
+Files are parsed as streams and staged per shard in a temporary table with
+large executemany batches. Each shard is then deduplicated in one set-based
+pass against Messages and against the archived months (MessageArchives) that
+the import touches: a row is new when its (user_id, timestamp, content)
+occurs more often in the import than it is stored, so re-running an import
+adds nothing, even after retention archived the first run. Genuine repeats inside one export are kept. New rows are
+inserted in timestamp order. For large imports the Messages index is dropped
+and rebuilt afterwards. MessageStats and Chats are then updated with one
+aggregated statement each.
+
+Imported messages do not publish live dashboard events. The similarity and
+analytics caches pick them up on their next incremental refresh.
+
+    python bulk_import.py chat_data.csv chat_data.txt output.csv
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+import retention
+import storage
+from core.db import MESSAGES_INDEX_SQL, init_db
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50000
+# Imports adding at least this many rows to a shard drop the Messages index and rebuild it afterwards.
+DEFER_INDEX_ROWS = 100000
+
+FORMATS = ("chat_csv", "messages_csv", "chat_txt")
+
+_CHAT_LINE = re.compile(r"^Chat ID (-?\d+): ?(.*)$")
+
+STAGING_TABLE_SQL = '''
+    CREATE TEMP TABLE IF NOT EXISTS ImportStaging (
+        seq INTEGER PRIMARY KEY,
+        chat_id INTEGER,
+        user_id INTEGER,
+        content TEXT,
+        timestamp TEXT
+    )
+'''
+
+# Messages from the archived (user, month) blobs the import touches.
+ARCHIVED_TABLE_SQL = '''
+    CREATE TEMP TABLE ImportArchived (
+        user_id INTEGER,
+        content TEXT,
+        timestamp TEXT
+    )
+'''
+
+
+# --- Parsers: each yields (chat_id, user_id, content, timestamp) ---
+
+def detect_format(path: str) -> str:
+    if path.endswith(".txt"):
+        return "chat_txt"
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        first = file.readline()
+    return "messages_csv" if first.strip().lower().startswith("id,chat_id") else "chat_csv"
+
+
+def _timestamp(value: str) -> str:
+    # Normalize to the isoformat insert_message writes, so dedup and date grouping agree.
+    return datetime.fromisoformat(value.strip()).isoformat()
+
+
+def parse_chat_csv(file, default_timestamp=None):
+    for row in csv.reader(file):
+        if len(row) < 4:
+            continue
+        user_id = int(row[1])
+        # Exported from private chats, where the chat id is the user id; the text may contain commas.
+        yield user_id, user_id, ",".join(row[3:]), _timestamp(row[0])
+
+
+def parse_messages_csv(file, default_timestamp=None):
+    for row in csv.DictReader(file):
+        if not row.get("user_id"):
+            continue
+        chat_id = int(row["chat_id"]) if row.get("chat_id") else int(row["user_id"])
+        yield chat_id, int(row["user_id"]), row["content"], _timestamp(row["timestamp"])
+
+
+def parse_chat_txt(file, default_timestamp=None):
+    pending = None
+    for line in file:
+        line = line.rstrip("\n")
+        match = _CHAT_LINE.match(line)
+        if match:
+            if pending:
+                yield pending
+            chat_id = int(match.group(1))
+            # Only private chats (positive ids) identify the sender.
+            pending = (chat_id, chat_id, match.group(2), default_timestamp) if chat_id > 0 else None
+        elif pending:
+            pending = pending[:2] + (pending[2] + "\n" + line,) + pending[3:]
+    if pending:
+        yield pending
+
+
+PARSERS = {"chat_csv": parse_chat_csv, "messages_csv": parse_messages_csv, "chat_txt": parse_chat_txt}
+
+
+# --- Import ---
+
+class BulkImporter:
+    """Stages parsed rows per shard, then merges every shard's staging table into Messages."""
+
+    def __init__(self, batch_size: int = BATCH_SIZE, defer_index_rows: int = DEFER_INDEX_ROWS):
+        shards = storage.backend()
+        if shards.name == "mysql":
+            raise SystemExit("bulk_import.py supports the SQLite backends; use LOAD DATA for MySQL")
+        self.batch_size = batch_size
+        self.defer_index_rows = defer_index_rows
+        self.shard_for = getattr(shards, "shard_for", lambda user_id: 0)
+        self.connections = [shards.connect_shard(index) for index in range(shards.shard_count)]
+        self.pending = [[] for _ in self.connections]
+        self.parsed = 0
+        self.seq = 0
+        for conn in self.connections:
+            conn.execute("PRAGMA temp_store = MEMORY")
+            conn.execute("PRAGMA cache_size = -262144")
+            conn.execute("DROP TABLE IF EXISTS temp.ImportStaging")
+            conn.execute(STAGING_TABLE_SQL)
+
+    def add(self, rows):
+        for chat_id, user_id, content, timestamp in rows:
+            self.seq += 1
+            index = self.shard_for(user_id)
+            batch = self.pending[index]
+            batch.append((self.seq, chat_id, user_id, content, timestamp))
+            if len(batch) >= self.batch_size:
+                self._stage(index)
+        for index in range(len(self.connections)):
+            self._stage(index)
+
+    def _stage(self, index: int):
+        batch = self.pending[index]
+        if not batch:
+            return
+        conn = self.connections[index]
+        conn.executemany(
+            'INSERT INTO temp.ImportStaging (seq, chat_id, user_id, content, timestamp) VALUES (?, ?, ?, ?, ?)',
+            batch)
+        conn.commit()
+        self.parsed += len(batch)
+        self.pending[index] = []
+
+    def merge(self) -> dict:
+        """Move new rows from every staging table into Messages; returns counts."""
+        inserted = 0
+        chats = {}
+        for conn in self.connections:
+            added, shard_chats = self._merge_shard(conn)
+            inserted += added
+            for chat_id, created_at in shard_chats:
+                chats[chat_id] = min(created_at, chats.get(chat_id, created_at))
+        self._insert_chats(chats)
+        for conn in self.connections:
+            conn.close()
+        return {"parsed": self.parsed, "inserted": inserted, "duplicates": self.parsed - inserted,
+                "chats_seen": len(chats)}
+
+    def _stage_archived(self, cursor):
+        """Unpack the archived months the staged rows fall in; returns the number of archived messages."""
+        cursor.execute(ARCHIVED_TABLE_SQL)
+        # Retention groups a user's messages by the first 7 characters of the timestamp (YYYY-MM).
+        blobs = cursor.execute('''
+            SELECT a.user_id, a.payload FROM main.MessageArchives AS a
+            JOIN (SELECT DISTINCT user_id, SUBSTR(timestamp, 1, 7) AS month FROM temp.ImportStaging) AS t
+              ON t.user_id = a.user_id AND t.month = a.month
+        ''').fetchall()
+        count = 0
+        for user_id, payload in blobs:
+            entries = [(user_id, content, ts) for _chat_id, content, ts in retention.archive_entries(payload)]
+            cursor.executemany('INSERT INTO temp.ImportArchived (user_id, content, timestamp) VALUES (?, ?, ?)',
+                               entries)
+            count += len(entries)
+        return count
+
+    def _merge_shard(self, conn):
+        cursor = conn.cursor()
+        cursor.execute('CREATE INDEX temp.idx_import_key ON ImportStaging (user_id, timestamp)')
+        archived = self._stage_archived(cursor)
+        if archived:
+            logger.info(f"Deduplicating against {archived} archived messages")
+        # How often each imported (user, timestamp, content) is already stored, in Messages or in an archive;
+        # one index probe per staged row, plus one per archived message of the touched months.
+        cursor.execute('''
+            CREATE TEMP TABLE ImportExisting AS
+            SELECT user_id, timestamp, content, SUM(stored) AS stored FROM (
+                SELECT m.user_id, m.timestamp, m.content, COUNT(DISTINCT m.id) AS stored
+                FROM temp.ImportStaging AS s
+                JOIN main.Messages AS m
+                  ON m.user_id = s.user_id AND m.timestamp = s.timestamp AND m.content = s.content
+                GROUP BY m.user_id, m.timestamp, m.content
+                UNION ALL
+                SELECT a.user_id, a.timestamp, a.content, COUNT(*) AS stored
+                FROM temp.ImportArchived AS a
+                WHERE EXISTS (SELECT 1 FROM temp.ImportStaging AS s
+                              WHERE s.user_id = a.user_id AND s.timestamp = a.timestamp AND s.content = a.content)
+                GROUP BY a.user_id, a.timestamp, a.content
+            )
+            GROUP BY user_id, timestamp, content
+        ''')
+        cursor.execute('CREATE INDEX temp.idx_import_existing ON ImportExisting (user_id, timestamp)')
+        # Rows whose key is not stored yet are all new; for stored keys, only the occurrences beyond the stored count.
+        cursor.execute('''
+            CREATE TEMP TABLE ImportNew AS
+            SELECT s.chat_id, s.user_id, s.content, s.timestamp
+            FROM temp.ImportStaging AS s
+            LEFT JOIN temp.ImportExisting AS e
+              ON e.user_id = s.user_id AND e.timestamp = s.timestamp AND e.content = s.content
+            WHERE e.stored IS NULL
+               OR (SELECT COUNT(*) FROM temp.ImportStaging AS o
+                   WHERE o.user_id = s.user_id AND o.timestamp = s.timestamp AND o.content = s.content
+                     AND o.seq <= s.seq) > e.stored
+            ORDER BY s.timestamp, s.seq
+        ''')
+        added = cursor.execute('SELECT COUNT(*) FROM temp.ImportNew').fetchone()[0]
+        chats = []
+        if added:
+            defer_index = added >= self.defer_index_rows
+            if defer_index:
+                cursor.execute('DROP INDEX IF EXISTS main.idx_messages_user_time')
+            cursor.execute('''
+                INSERT INTO main.Messages (chat_id, user_id, content, timestamp)
+                SELECT chat_id, user_id, content, timestamp FROM temp.ImportNew ORDER BY rowid
+            ''')
+            cursor.execute('''
+                INSERT INTO main.MessageStats (user_id, date, message_count)
+                SELECT user_id, SUBSTR(timestamp, 1, 10) AS day, COUNT(*) FROM temp.ImportNew
+                WHERE true  -- SQLite needs a WHERE before ON CONFLICT in INSERT ... SELECT
+                GROUP BY user_id, day
+                ON CONFLICT(user_id, date) DO UPDATE SET message_count = message_count + excluded.message_count
+            ''')
+            if defer_index:
+                cursor.execute(MESSAGES_INDEX_SQL)
+            chats = cursor.execute('SELECT chat_id, MIN(timestamp) FROM temp.ImportNew GROUP BY chat_id').fetchall()
+        conn.commit()
+        for table in ("ImportNew", "ImportExisting", "ImportArchived", "ImportStaging"):
+            cursor.execute(f'DROP TABLE temp.{table}')
+        return added, chats
+
+    def _insert_chats(self, chats: dict):
+        # Chats are sharded by chat_id, which for group chats differs from the messages' shard.
+        by_shard = {}
+        for chat_id, created_at in chats.items():
+            by_shard.setdefault(self.shard_for(chat_id), []).append((chat_id, None, created_at))
+        for index, rows in by_shard.items():
+            conn = storage.backend().connect_shard(index)
+            conn.executemany('INSERT OR IGNORE INTO Chats (chat_id, chat_name, created_at) VALUES (?, ?, ?)', rows)
+            conn.commit()
+            conn.close()
+
+
+def import_files(paths, file_format: str = None, default_timestamp: str = None,
+                 batch_size: int = BATCH_SIZE, defer_index_rows: int = DEFER_INDEX_ROWS) -> dict:
+    """Import every file in `paths`; returns row counts and throughput."""
+    started = time.perf_counter()
+    importer = BulkImporter(batch_size, defer_index_rows)
+    for path in paths:
+        kind = file_format or detect_format(path)
+        timestamp = default_timestamp or datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+        with open(path, "r", encoding="utf-8", newline="") as file:
+            before = importer.seq
+            importer.add(PARSERS[kind](file, timestamp))
+        logger.info(f"Parsed {importer.seq - before} messages from {path} ({kind})")
+    parsed_at = time.perf_counter()
+    report = importer.merge()
+    finished = time.perf_counter()
+    report.update({
+        "parse_seconds": round(parsed_at - started, 2),
+        "merge_seconds": round(finished - parsed_at, 2),
+        "rows_per_second": round(report["parsed"] / max(finished - started, 1e-9)),
+    })
+    return report
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Bulk import legacy message exports into the database")
+    parser.add_argument('paths', nargs='+', help="chat_data.csv, chat_data.txt or output.csv style files")
+    parser.add_argument('--format', choices=FORMATS, help="skip format detection")
+    parser.add_argument('--timestamp', type=_timestamp,
+                        help="timestamp for formats without one (default: the file's modification time)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--defer-index-rows', type=int, default=DEFER_INDEX_ROWS,
+                        help="drop and rebuild the Messages index when a shard gains this many rows")
+    args = parser.parse_args()
+    init_db()
+    try:
+        report = import_files(args.paths, args.format, args.timestamp, args.batch_size, args.defer_index_rows)
+    except (ValueError, KeyError) as e:
+        sys.exit(f"Could not parse input: {e}")
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,111 @@
+"""
+Per-user ordered, cross-user concurrent update processing for the bot.
+
+python-telegram-bot processes updates one at a time by default, so a slow
+OpenAI round-trip for one user holds up everyone else. `PerUserUpdateProcessor`
+lets updates run concurrently but serializes them per user with keyed asyncio
+locks: a user's messages, history writes and analyses still happen strictly in
+arrival order, while different users progress in parallel.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+USER_WAIT = "analyzebot_user_queue_wait_seconds"
+USERS_WAITING = "analyzebot_user_queue_waiting"
+ACTIVE_UPDATES = "analyzebot_active_updates"
+
+metrics.describe(USER_WAIT, "Time an update waited for earlier updates of the same user.")
+metrics.describe(USERS_WAITING, "Updates currently queued behind another update of the same user.")
+metrics.describe(ACTIVE_UPDATES, "Updates currently being processed.")
+
+
+class KeyedLock:
+    """A FIFO asyncio lock per key; entries are dropped as soon as nobody holds or waits on them."""
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+def update_key(update: object):
+    """Serialization key of an update: the user, falling back to the chat."""
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Run up to `max_concurrent_updates` handlers at once, one per user at a time.
+
+    The base class semaphore only bounds how many updates may be pending
+    (`max_pending_updates`); the concurrency limit is applied after the
+    per-user lock so that a user with a backlog does not occupy worker slots
+    while waiting for their own earlier messages.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = None):
+        super().__init__(max_pending_updates or max_concurrent_updates * 64)
+        self.max_active_updates = max_concurrent_updates
+        self._active = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks = KeyedLock()
+        metrics.gauge_callback("analyzebot_user_locks", lambda: len(self._user_locks))
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            async with self._active:
+                await self._run(coroutine)
+            return
+
+        queued = time.perf_counter()
+        metrics.add_gauge(USERS_WAITING, 1)
+        try:
+            async with self._user_locks.hold(key):
+                metrics.add_gauge(USERS_WAITING, -1)
+                queued, waited = None, time.perf_counter() - queued
+                metrics.observe(USER_WAIT, waited)
+                async with self._active:
+                    await self._run(coroutine)
+        finally:
+            if queued is not None:
+                # Cancelled while still waiting for the lock.
+                metrics.add_gauge(USERS_WAITING, -1)
+
+    async def _run(self, coroutine):
+        metrics.add_gauge(ACTIVE_UPDATES, 1)
+        try:
+            await coroutine
+        finally:
+            metrics.add_gauge(ACTIVE_UPDATES, -1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,7 @@
+"""
+Code shared by the bot (bot_mentalx.py) and the dashboard (app.py).
+
+Nothing here does work at import time: config.json is read, the OpenAI
+client is built and the storage backend is opened on first use, and the
+schema is created only when `core.db.init_db()` is called.
+"""
@@ -0,0 +1,249 @@
+"""
+Cohort analytics over cached pandas frames.
+
+Two frames are kept in memory:
+
+* `daily`: one row per (user_id, date) with the number of messages. Days
+  before today come from MessageStats, the long-term rollup that retention
+  never archives, reloaded every `history_seconds` and when the date changes.
+  Today's counts are aggregated from Messages above the last id seen on each
+  shard and added in on every refresh.
+* `users`: one row per authorized user with age, gender, country and the
+  latest risk category. This frame is small and is reloaded on every refresh.
+
+Cohort questions ("messages per day by country", "average risk by age range")
+are vectorized groupbys over these frames, so they do not hit the database.
+Results come back in Chart.js shape (`{"labels": [...], "datasets": [...]}`),
+which plotly can also plot directly.
+
+pandas is optional: without it `available()` is False and the API answers 503.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+
+try:
+    import pandas as pd
+except ImportError:  # pragma: no cover - optional dependency
+    pd = None
+
+import metrics
+import storage
+from core.config import get_config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS = {
+    # Minimum seconds between refreshes triggered by queries.
+    "refresh_seconds": 30,
+    # Seconds between reloads of the earlier days from MessageStats (bulk imports backfill it).
+    "history_seconds": 3600,
+}
+
+# Cohort name -> column of the users frame.
+COHORTS = {"country": "country", "age": "age", "gender": "gender", "risk": "risk_category"}
+UNKNOWN = "Unknown"
+
+
+def available() -> bool:
+    return pd is not None
+
+
+def _options() -> dict:
+    return dict(DEFAULT_OPTIONS, **(get_config().get('analytics') or {}))
+
+
+def _risk_label(category) -> str:
+    # Stored categories come straight from the model ("Red", "red - immediate help", ...).
+    if not isinstance(category, str) or not category.strip():
+        return "Unscored"
+    return category.strip().split()[0].strip(":-,.").capitalize()
+
+
+# --- Cache ---
+
+class CohortCache:
+    """Per-(user, day) message counts and user attributes, refreshed from the database."""
+
+    def __init__(self):
+        self.daily = None
+        self.users = None
+        self.history = None
+        self.today = None
+        self.day = None
+        self.last_ids = []
+        self._history_loaded = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self) -> int:
+        """Reload the history when due, fold today's new messages into `daily` and reload `users`.
+
+        Returns the number of today's messages added.
+        """
+        with self._lock, metrics.span("analytics.refresh"):
+            day = datetime.now().date().isoformat()
+            shard_count = storage.backend().shard_count
+            if day != self.day or len(self.last_ids) != shard_count:
+                # A new day (or shard layout): yesterday's counts now come from MessageStats.
+                self.day = day
+                self.last_ids = [0] * shard_count
+                self.today = pd.DataFrame({"user_id": pd.Series(dtype="int64"),
+                                           "messages": pd.Series(dtype="int64")})
+                self.history = None
+            if self.history is None or time.monotonic() - self._history_loaded >= _options()["history_seconds"]:
+                self._load_history(day)
+
+            def query(conn, index):
+                cursor = conn.cursor()
+                cursor.execute('SELECT MAX(id) FROM Messages')
+                max_id = cursor.fetchone()[0] or 0
+                # Bounded by max_id, so the cursor moves past exactly the rows counted here.
+                cursor.execute('''
+                    SELECT user_id, COUNT(*) FROM Messages
+                    WHERE id > ? AND id <= ? AND timestamp >= ? AND user_id IS NOT NULL
+                    GROUP BY user_id
+                ''', (self.last_ids[index], max_id, day))
+                return max_id, cursor.fetchall()
+
+            frames = []
+            for index, (max_id, rows) in enumerate(storage.fan_out(query, with_index=True)):
+                self.last_ids[index] = max_id
+                if rows:
+                    frames.append(pd.DataFrame(rows, columns=["user_id", "messages"]))
+            added = 0
+            if frames:
+                new = pd.concat(frames, ignore_index=True)
+                added = int(new["messages"].sum())
+                self.today = (pd.concat([self.today, new], ignore_index=True)
+                              .groupby("user_id", as_index=False, sort=False)["messages"].sum())
+            today = self.today.assign(date=pd.Timestamp(day))[["user_id", "date", "messages"]]
+            self.daily = pd.concat([self.history, today], ignore_index=True)
+
+            def users_query(conn):
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT a.user_id, a.age, a.gender, a.country, m.mental_percent, m.risk_category
+                    FROM Authorizations a
+                    LEFT JOIN UserMentalHealth m ON m.user_id = a.user_id
+                ''')
+                return cursor.fetchall()
+
+            users = pd.DataFrame([row for rows in storage.fan_out(users_query) for row in rows],
+                                 columns=["user_id", "age", "gender", "country", "mental_percent", "risk_category"])
+            users[["age", "gender", "country"]] = users[["age", "gender", "country"]].fillna(UNKNOWN)
+            users["mental_percent"] = pd.to_numeric(users["mental_percent"], errors="coerce")
+            users["risk_category"] = users["risk_category"].map(_risk_label)
+            self.users = users.drop_duplicates("user_id", keep="last")
+            return added
+
+    def _load_history(self, day: str):
+        """Per-(user, day) counts before `day` from MessageStats, which keeps archived days too."""
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id, date, message_count FROM MessageStats WHERE date < ?', (day,))
+            return cursor.fetchall()
+
+        history = pd.DataFrame([row for rows in storage.fan_out(query) for row in rows],
+                               columns=["user_id", "date", "messages"])
+        history["user_id"] = history["user_id"].astype("int64")
+        history["date"] = pd.to_datetime(history["date"])
+        history["messages"] = history["messages"].astype("int64")
+        self.history = history
+        self._history_loaded = time.monotonic()
+
+    def cohort_frame(self, column: str, since) -> "pd.DataFrame":
+        """Rows of `daily` from `since` on, with the users' `column` attached (UNKNOWN without an authorization)."""
+        frame = self.daily[self.daily["date"] >= since]
+        labels = frame["user_id"].map(self.users.set_index("user_id")[column])
+        missing = "Unscored" if column == "risk_category" else UNKNOWN
+        return frame.assign(**{column: labels.fillna(missing)})
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_last_refresh = 0.0
+
+
+def get_cache(refresh: bool = True) -> CohortCache:
+    """The process-wide cache, refreshed from the database at most every `refresh_seconds`."""
+    global _cache, _last_refresh
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CohortCache()
+    if refresh and (_cache.daily is None or time.monotonic() - _last_refresh >= _options()["refresh_seconds"]):
+        _last_refresh = time.monotonic()
+        _cache.refresh()
+    return _cache
+
+
+# --- Queries ---
+
+def _cohort_column(by: str) -> str:
+    if by not in COHORTS:
+        raise ValueError(f"Unknown cohort {by!r}; expected one of {', '.join(COHORTS)}")
+    return COHORTS[by]
+
+
+def _date_range(days: int):
+    end = pd.Timestamp.now().normalize()
+    return pd.date_range(end - pd.Timedelta(days=days - 1), end, freq="D")
+
+
+def messages_per_day(by: str, days: int = 30) -> dict:
+    """Messages per day for each cohort over the last `days` days, zero-filled."""
+    column = _cohort_column(by)
+    dates = _date_range(days)
+    frame = get_cache().cohort_frame(column, dates[0])
+    table = (frame.groupby([column, "date"])["messages"].sum()
+             .unstack(column, fill_value=0)
+             .reindex(dates, fill_value=0))
+    table = table[table.sum().sort_values(ascending=False).index]
+    return {
+        "labels": [d.strftime("%Y-%m-%d") for d in dates],
+        "datasets": [{"label": str(cohort), "data": table[cohort].astype(int).tolist()} for cohort in table.columns],
+    }
+
+
+def cohort_summary(by: str, days: int = 30) -> dict:
+    """Users, messages, messages per active user and average risk % for each cohort."""
+    column = _cohort_column(by)
+    cache = get_cache()
+    frame = cache.cohort_frame(column, _date_range(days)[0])
+    activity = frame.groupby(column).agg(messages=("messages", "sum"), active_users=("user_id", "nunique"))
+    population = cache.users.groupby(column).agg(users=("user_id", "size"), avg_risk=("mental_percent", "mean"))
+    summary = population.join(activity, how="outer").fillna({"users": 0, "messages": 0, "active_users": 0})
+    summary = summary.sort_values("messages", ascending=False)
+    per_user = (summary["messages"] / summary["active_users"].where(summary["active_users"] > 0)).round(2)
+
+    def values(series):
+        return [None if pd.isna(v) else round(float(v), 2) for v in series]
+
+    return {
+        "labels": [str(label) for label in summary.index],
+        "datasets": [
+            {"label": "Users", "data": summary["users"].astype(int).tolist()},
+            {"label": "Active users", "data": summary["active_users"].astype(int).tolist()},
+            {"label": "Messages", "data": summary["messages"].astype(int).tolist()},
+            {"label": "Messages per active user", "data": values(per_user)},
+            {"label": "Average risk %", "data": values(summary["avg_risk"])},
+        ],
+    }
+
+
+def user_daily_messages(user_id: int, days: int = None) -> dict:
+    """One user's messages per day, zero-filled over the last `days` days or their whole active span."""
+    daily = get_cache().daily
+    counts = daily[daily["user_id"] == user_id].set_index("date")["messages"].sort_index()
+    if counts.empty:
+        return {"labels": [], "datasets": [{"label": "Messages", "data": []}]}
+    if days is None:
+        dates = pd.date_range(counts.index.min(), counts.index.max(), freq="D")
+    else:
+        dates = _date_range(days)
+    counts = counts.reindex(dates, fill_value=0)
+    return {
+        "labels": [d.strftime("%Y-%m-%d") for d in dates],
+        "datasets": [{"label": "Messages", "data": counts.astype(int).tolist()}],
+    }
@@ -0,0 +1,13 @@
+"""Lazily loaded config.json."""
+import functools
+import json
+
+CONFIG_FILE = 'config.json'
+DB_FILE = 'telegram_bot.db'
+
+
+@functools.lru_cache(maxsize=None)
+def get_config() -> dict:
+    """Read config.json once, on first use."""
+    with open(CONFIG_FILE, 'r') as file:
+        return json.load(file)
@@ -0,0 +1,499 @@
+"""
+Schema and database helper functions used by both the bot and the dashboard.
+
+Connections come from storage.py, which opens the configured backend on first
+use. The schema is created explicitly with `init_db()`:
+
+    python -m core.db
+"""
+from datetime import datetime, timedelta
+
+import metrics
+import retention
+import storage
+from core import events, usage
+
+# --- Schema ---
+
+# Users whose average score over their last 3 scorings is at least 10 points above
+# the average of the (up to 7) scorings before those.
+DETERIORATING_VIEW_SQL = '''
+    CREATE VIEW IF NOT EXISTS DeterioratingUsers AS
+    SELECT user_id,
+           AVG(CASE WHEN recency <= 3 THEN mental_percent END) AS recent_avg,
+           AVG(CASE WHEN recency > 3 THEN mental_percent END) AS previous_avg,
+           AVG(CASE WHEN recency <= 3 THEN mental_percent END)
+               - AVG(CASE WHEN recency > 3 THEN mental_percent END) AS delta,
+           MAX(CASE WHEN recency = 1 THEN risk_category END) AS risk_category,
+           MAX(recorded_at) AS last_recorded_at
+    FROM (
+        SELECT user_id, mental_percent, risk_category, recorded_at,
+               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY recorded_at DESC) AS recency
+        FROM RiskHistory
+    ) AS ranked
+    WHERE recency <= 10
+    GROUP BY user_id
+    HAVING COUNT(*) > 3
+       AND AVG(CASE WHEN recency <= 3 THEN mental_percent END)
+           - AVG(CASE WHEN recency > 3 THEN mental_percent END) >= 10
+'''
+
+# History lookups filter by user and sort by time; bulk_import.py drops and rebuilds it for large loads.
+MESSAGES_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS idx_messages_user_time ON Messages (user_id, timestamp)'
+
+def init_db():
+    """Initialize the database (every shard, when sharded) with required tables."""
+    sqlite = storage.backend().name != "mysql"
+    for conn in storage.connect_all():
+        if sqlite:
+            # Only takes effect before the first table exists: new files start in the mode retention's
+            # incremental VACUUM needs. Existing files are converted once with `retention.py --full-vacuum`.
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        _create_tables(conn)
+
+def _create_tables(conn):
+    cursor = conn.cursor()
+    # Chats table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER UNIQUE,
+            chat_name TEXT,
+            created_at TEXT
+        )
+    ''')
+    # Messages table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            content TEXT,
+            timestamp TEXT,
+            FOREIGN KEY (chat_id) REFERENCES Chats(chat_id)
+        )
+    ''')
+    cursor.execute(MESSAGES_INDEX_SQL)
+    # Analyses table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Analyses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            analysis_result TEXT,
+            updated_at TEXT
+        )
+    ''')
+    # MessageStats table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS MessageStats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            date TEXT,
+            message_count INTEGER,
+            UNIQUE(user_id, date)
+        )
+    ''')
+    # Authorizations table for storing authorization data
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Authorizations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            age TEXT,
+            gender TEXT,
+            country TEXT,
+            created_at TEXT
+        )
+    ''')
+    # UserMentalHealth table for storing mental health risk data
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS UserMentalHealth (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            mental_percent REAL,
+            risk_category TEXT,
+            updated_at TEXT
+        )
+    ''')
+    # RiskHistory table: append-only log of every mental health scoring
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS RiskHistory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            mental_percent REAL,
+            risk_category TEXT,
+            recorded_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_riskhistory_user_time ON RiskHistory (user_id, recorded_at)')
+    # Replies table: the bot's final answers, with time to first text and total latency
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Replies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            content TEXT,
+            streamed INTEGER,
+            ttft_ms REAL,
+            latency_ms REAL,
+            edits INTEGER,
+            created_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_replies_time ON Replies (created_at)')
+    # Start the history from the current scores the first time the table is created.
+    cursor.execute('''
+        INSERT INTO RiskHistory (user_id, mental_percent, risk_category, recorded_at)
+        SELECT user_id, mental_percent, risk_category, updated_at FROM UserMentalHealth
+        WHERE NOT EXISTS (SELECT 1 FROM RiskHistory)
+    ''')
+    cursor.execute(DETERIORATING_VIEW_SQL)
+    # Persisted user_data and conversation states (see persistence.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS BotUserData (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT,
+            updated_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS BotConversations (
+            name TEXT,
+            conv_key TEXT,
+            state TEXT,
+            updated_at REAL,
+            PRIMARY KEY (name, conv_key)
+        )
+    ''')
+    # MessageArchives table: compressed per-user, per-month history (see retention.py)
+    cursor.execute(retention.ARCHIVE_TABLE_SQL)
+    # Events table: live feed for the dashboard (see core/events.py)
+    cursor.execute(events.EVENTS_TABLE_SQL)
+    # LLMUsage table: tokens, latency and cost of every OpenAI call (see core/usage.py)
+    cursor.execute(usage.USAGE_TABLE_SQL)
+    for index_sql in usage.USAGE_INDEX_SQL:
+        cursor.execute(index_sql)
+    conn.commit()
+    conn.close()
+
+# --- Writes from the bot ---
+
+@metrics.instrument("db.insert_chat")
+def insert_chat(chat):
+    """Insert chat info into the Chats table if not already present."""
+    conn = storage.connect(chat.id)
+    cursor = conn.cursor()
+    cursor.execute('SELECT chat_id FROM Chats WHERE chat_id = ?', (chat.id,))
+    if cursor.fetchone() is None:
+        chat_name = getattr(chat, 'title', None)
+        cursor.execute(
+            'INSERT INTO Chats (chat_id, chat_name, created_at) VALUES (?, ?, ?)',
+            (chat.id, chat_name, datetime.now().isoformat())
+        )
+        conn.commit()
+    conn.close()
+
+@metrics.instrument("db.insert_message")
+def insert_message(chat, user, content):
+    """Insert a new message into the Messages table and update daily stats."""
+    now = datetime.now()
+    conn = storage.connect(user.id)
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT INTO Messages (chat_id, user_id, content, timestamp) VALUES (?, ?, ?, ?)',
+        (chat.id, user.id, content, now.isoformat())
+    )
+    current_date = now.date().isoformat()
+    cursor.execute('''
+        INSERT INTO MessageStats (user_id, date, message_count)
+        VALUES (?, ?, 1)
+        ON CONFLICT(user_id, date) DO UPDATE SET message_count = message_count + 1
+    ''', (user.id, current_date))
+    conn.commit()
+    conn.close()
+    events.publish(events.MESSAGE, user.id, {"chat_id": chat.id, "timestamp": now.isoformat()})
+
+@metrics.instrument("db.insert_authorization")
+def insert_authorization(user_id: int, age: str, gender: str, country: str):
+    """Insert or update authorization data for a given user."""
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    now = datetime.now().isoformat()
+    cursor.execute('''
+        INSERT OR REPLACE INTO Authorizations (user_id, age, gender, country, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, age, gender, country, now))
+    conn.commit()
+    conn.close()
+    events.publish(events.AUTHORIZATION, user_id,
+                   {"age": age, "gender": gender, "country": country, "created_at": now})
+
+@metrics.instrument("db.update_user_analysis")
+def update_user_analysis(user_id: int, analysis_result: str):
+    """Insert or update the analysis result for a given user in the Analyses table."""
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    now = datetime.now().isoformat()
+    cursor.execute('''
+        INSERT INTO Analyses (user_id, analysis_result, updated_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            analysis_result = excluded.analysis_result,
+            updated_at = excluded.updated_at
+    ''', (user_id, analysis_result, now))
+    conn.commit()
+    conn.close()
+
+@metrics.instrument("db.update_user_mental_health")
+def update_user_mental_health(user_id: int, mental_percent: float, risk_category: str):
+    """Store the latest mental health risk percentage for a given user and append it to RiskHistory."""
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    now = datetime.now().isoformat()
+    cursor.execute('SELECT risk_category FROM UserMentalHealth WHERE user_id = ?', (user_id,))
+    previous = cursor.fetchone()
+    previous_category = previous[0] if previous else None
+    cursor.execute('''
+        INSERT OR REPLACE INTO UserMentalHealth (user_id, mental_percent, risk_category, updated_at)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, mental_percent, risk_category, now))
+    cursor.execute('''
+        INSERT INTO RiskHistory (user_id, mental_percent, risk_category, recorded_at)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, mental_percent, risk_category, now))
+    conn.commit()
+    conn.close()
+    events.publish(events.RISK, user_id, {
+        "mental_percent": mental_percent,
+        "risk_category": risk_category,
+        "previous_category": previous_category,
+        "crossed_red": events.is_red(risk_category) and not events.is_red(previous_category),
+        "updated_at": now,
+    })
+
+@metrics.instrument("db.insert_reply")
+def insert_reply(user_id: int, chat_id: int, content: str, streamed: bool, ttft_ms: float, latency_ms: float,
+                 edits: int = 0):
+    """Store a reply sent to the user; without streaming, the first text arrives with the whole reply."""
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO Replies (user_id, chat_id, content, streamed, ttft_ms, latency_ms, edits, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, chat_id, content, int(streamed), ttft_ms, latency_ms, edits, datetime.now().isoformat()))
+    conn.commit()
+    conn.close()
+
+# --- Reads ---
+
+@metrics.instrument("db.get_all_users")
+def get_all_users() -> list:
+    """Retrieve a list of distinct user IDs from the Messages table."""
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('SELECT DISTINCT user_id FROM Messages ORDER BY user_id')
+        return [u[0] for u in cursor.fetchall()]
+    return sorted(user_id for shard_users in storage.fan_out(query) for user_id in shard_users)
+
+@metrics.instrument("db.get_all_authorizations")
+def get_all_authorizations():
+    """Return all authorization records from the database."""
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, age, gender, country, created_at FROM Authorizations")
+        return cursor.fetchall()
+    return [user for shard_users in storage.fan_out(query) for user in shard_users]
+
+@metrics.instrument("db.get_authorization_by_user")
+def get_authorization_by_user(user_id: int):
+    """Return the authorization record for a given user_id."""
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, age, gender, country, created_at FROM Authorizations WHERE user_id = ?", (user_id,))
+    user = cursor.fetchone()
+    conn.close()
+    return user
+
+@metrics.instrument("db.get_user_messages")
+def get_user_messages(user_id: int, limit: int = None):
+    """Retrieve the messages sent by the user, ordered by timestamp.
+
+    With `limit`, only the newest `limit` rows of the hot Messages table are read and archives are skipped.
+    """
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    if limit is not None:
+        cursor.execute("SELECT content, timestamp FROM Messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
+                       (user_id, limit))
+        messages = cursor.fetchall()[::-1]
+        conn.close()
+        return messages
+    cursor.execute("SELECT content, timestamp FROM Messages WHERE user_id = ? ORDER BY timestamp", (user_id,))
+    messages = cursor.fetchall()
+    archived = retention.get_archived_messages(conn, user_id)
+    conn.close()
+    if archived:
+        messages = sorted(archived + messages, key=lambda message: message[1])
+    return messages
+
+@metrics.instrument("db.get_user_history")
+def get_user_history(user_id: int, timestamps: bool = False, limit: int = None) -> str:
+    """Combine the messages of a given user (all, or the newest `limit`) into a single string, one per line."""
+    messages = get_user_messages(user_id, limit)
+    if timestamps:
+        return "\n".join(f"[{ts}] {content}" for content, ts in messages)
+    return "\n".join(content for content, _ in messages)
+
+@metrics.instrument("db.get_user_analysis")
+def get_user_analysis(user_id: int):
+    """Retrieve the latest (analysis_result, updated_at) for a given user from the Analyses table."""
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    cursor.execute("SELECT analysis_result, updated_at FROM Analyses WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return row if row else ("No analysis available.", "")
+
+@metrics.instrument("db.get_message_stats")
+def get_message_stats(user_id: int) -> list:
+    """Retrieve daily message statistics for a given user (date, message_count)."""
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT date, message_count FROM MessageStats
+        WHERE user_id = ?
+        ORDER BY date ASC
+    ''', (user_id,))
+    stats = cursor.fetchall()
+    conn.close()
+    return stats
+
+@metrics.instrument("db.get_distribution")
+def get_distribution(column: str):
+    """Return labels and counts for a given column in Authorizations."""
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {column}, COUNT(*) FROM Authorizations GROUP BY {column}")
+        return cursor.fetchall()
+    totals = {}
+    for rows in storage.fan_out(query):
+        for label, count in rows:
+            totals[label] = totals.get(label, 0) + count
+    labels = list(totals)
+    counts = [totals[label] for label in labels]
+    return labels, counts
+
+@metrics.instrument("db.get_user_mental_health")
+def get_user_mental_health(user_id: int):
+    """Retrieve mental health risk data for a given user."""
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    cursor.execute("SELECT mental_percent, risk_category, updated_at FROM UserMentalHealth WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return row if row else (None, None, None)
+
+# --- Risk trends ---
+
+@metrics.instrument("db.get_risk_history")
+def get_risk_history(user_id: int, limit: int = 30) -> list:
+    """Return the user's last `limit` scorings as (recorded_at, mental_percent, risk_category), oldest first."""
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT recorded_at, mental_percent, risk_category FROM RiskHistory
+        WHERE user_id = ?
+        ORDER BY recorded_at DESC
+        LIMIT ?
+    ''', (user_id, limit))
+    rows = cursor.fetchall()
+    conn.close()
+    return rows[::-1]
+
+@metrics.instrument("db.get_daily_risk")
+def get_daily_risk(user_id: int, days: int = 90) -> list:
+    """Return (date, min, avg, max, scorings) per day over the last `days` days, oldest first."""
+    since = (datetime.now() - timedelta(days=days)).date().isoformat()
+    conn = storage.connect(user_id)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT SUBSTR(recorded_at, 1, 10) AS day,
+               MIN(mental_percent), AVG(mental_percent), MAX(mental_percent), COUNT(*)
+        FROM RiskHistory
+        WHERE user_id = ? AND recorded_at >= ?
+        GROUP BY day
+        ORDER BY day
+    ''', (user_id, since))
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+@metrics.instrument("db.get_risk_histories")
+def get_risk_histories(user_ids, limit: int = 20) -> dict:
+    """Return {user_id: [mental_percent, ...]} with the last `limit` scorings of each user, oldest first."""
+    user_ids = list(user_ids)
+    # One statement per 500 users keeps well under the bound-parameter limit.
+    chunks = [user_ids[i:i + 500] for i in range(0, len(user_ids), 500)]
+
+    def query(conn):
+        cursor = conn.cursor()
+        rows = []
+        for chunk in chunks:
+            cursor.execute(f'''
+                SELECT user_id, mental_percent FROM (
+                    SELECT user_id, mental_percent, recorded_at,
+                           ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY recorded_at DESC) AS recency
+                    FROM RiskHistory
+                    WHERE user_id IN ({", ".join("?" * len(chunk))})
+                ) AS ranked
+                WHERE recency <= ?
+                ORDER BY user_id, recorded_at
+            ''', (*chunk, limit))
+            rows.extend(cursor.fetchall())
+        return rows
+
+    histories = {user_id: [] for user_id in user_ids}
+    for rows in storage.fan_out(query):
+        for user_id, mental_percent in rows:
+            histories[user_id].append(mental_percent)
+    return histories
+
+@metrics.instrument("db.get_deteriorating_users")
+def get_deteriorating_users() -> list:
+    """Return (user_id, recent_avg, previous_avg, delta, risk_category, last_recorded_at), largest rise first."""
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, recent_avg, previous_avg, delta, risk_category, last_recorded_at
+            FROM DeterioratingUsers
+        ''')
+        return cursor.fetchall()
+    rows = [row for shard_rows in storage.fan_out(query) for row in shard_rows]
+    return sorted(rows, key=lambda row: row[3], reverse=True)
+
+@metrics.instrument("db.get_reply_latency")
+def get_reply_latency(days: int = 30) -> list:
+    """Return (streamed, replies, avg_ttft_ms, avg_latency_ms, avg_edits) over the last `days` days."""
+    since = (datetime.now() - timedelta(days=days)).isoformat()
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT streamed, COUNT(*), SUM(ttft_ms), SUM(latency_ms), SUM(edits)
+            FROM Replies WHERE created_at >= ?
+            GROUP BY streamed
+        ''', (since,))
+        return cursor.fetchall()
+    totals = {}
+    for rows in storage.fan_out(query):
+        for streamed, count, ttft, latency, edits in rows:
+            total = totals.setdefault(bool(streamed), [0, 0.0, 0.0, 0])
+            total[0] += count
+            total[1] += ttft or 0
+            total[2] += latency or 0
+            total[3] += edits or 0
+    return [(streamed, count, ttft / count, latency / count, edits / count)
+            for streamed, (count, ttft, latency, edits) in sorted(totals.items())]
+
+
+if __name__ == '__main__':
+    init_db()
+    print(f"Schema ready in {', '.join(storage.backend().database_files()) or storage.backend().name}")
@@ -0,0 +1,252 @@
+"""
+Live change feed for the dashboard.
+
+The database helpers publish an event whenever a message is stored, a risk
+score is written or a user completes authorization. Events are appended to
+the Events table of the user's database (their shard, when sharded), so the
+feed scales with the other writes. The table is what lets the bot process
+reach the dashboard process, and also lets a reconnecting browser replay
+everything after the last event it saw.
+
+Every shard numbers its events separately, so a position in the feed is a
+cursor of one last-seen id per shard, written as "12.40.7" ("12" with a single
+database). It is sent to the browser as the SSE event id.
+
+Inside the dashboard process one `EventHub` thread polls every shard and hands
+new events to every subscriber, so the database cost does not grow with the
+number of open dashboards. Publishing processes delete events older than
+`events_keep_days` (config.json, default 7) about once an hour.
+"""
+import contextlib
+import heapq
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import metrics
+import storage
+from core.config import get_config
+
+logger = logging.getLogger(__name__)
+
+EVENT_BATCH = 500
+KEEP_DAYS = 7
+# Seconds between the prunes a publishing process starts.
+PRUNE_INTERVAL = 3600
+
+MESSAGE = "message"
+RISK = "risk"
+AUTHORIZATION = "authorization"
+
+PUBLISHED = "analyzebot_events_published_total"
+SUBSCRIBERS = "analyzebot_event_subscribers"
+metrics.describe(PUBLISHED, "Live feed events written to the Events table, by kind.")
+metrics.describe(SUBSCRIBERS, "Dashboard live feed connections open in this process.")
+
+EVENTS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS Events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT,
+        user_id INTEGER,
+        payload TEXT,
+        created_at TEXT
+    )
+'''
+
+
+def is_red(risk_category) -> bool:
+    return bool(risk_category) and risk_category.strip().lower().startswith("red")
+
+
+def keep_days() -> int:
+    return get_config().get('events_keep_days', KEEP_DAYS)
+
+
+# --- Cursors ---
+
+def format_cursor(cursor: list) -> str:
+    return ".".join(str(event_id) for event_id in cursor)
+
+
+def parse_cursor(text):
+    """Cursor list from a Last-Event-ID or `after` value; None when missing or written for another shard count."""
+    parts = (text or "").split(".")
+    if len(parts) != storage.backend().shard_count or not all(part.isdigit() for part in parts):
+        return None
+    return [int(part) for part in parts]
+
+
+def is_seen(cursor: list, event: dict) -> bool:
+    return event["id"] <= cursor[event["shard"]]
+
+
+def advance(cursor: list, event: dict) -> list:
+    cursor = list(cursor)
+    cursor[event["shard"]] = event["id"]
+    return cursor
+
+
+# --- Publishing ---
+
+_prune_lock = threading.Lock()
+_next_prune = 0.0
+
+
+def publish(kind: str, user_id: int, payload: dict):
+    """Append an event to the user's Events table; failures are logged, never raised to the caller."""
+    try:
+        conn = storage.connect(user_id)
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO Events (kind, user_id, payload, created_at) VALUES (?, ?, ?, ?)',
+            (kind, user_id, json.dumps(payload, ensure_ascii=False), datetime.now().isoformat())
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"Could not publish {kind} event for user {user_id}: {e}")
+        return
+    metrics.inc(PUBLISHED, kind=kind)
+    HUB.wake()
+    _maybe_prune()
+
+
+def _maybe_prune():
+    # Pruning rides on publishing, so it happens whether or not retention is configured.
+    global _next_prune
+    with _prune_lock:
+        if time.monotonic() < _next_prune:
+            return
+        _next_prune = time.monotonic() + PRUNE_INTERVAL
+    threading.Thread(target=_prune, name="event-prune", daemon=True).start()
+
+
+def _prune():
+    try:
+        removed = prune_events()
+    except Exception as e:
+        logger.error(f"Could not prune events: {e}")
+        return
+    if removed:
+        logger.info(f"Pruned {removed} events older than {keep_days()} days")
+
+
+# --- Reading ---
+
+def current_cursor() -> list:
+    """The last event id of every shard."""
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('SELECT MAX(id) FROM Events')
+        return cursor.fetchone()[0] or 0
+
+    return storage.fan_out(query)
+
+
+def events_after(after: list, limit: int = None) -> list:
+    """Return up to `limit` events past the cursor `after` as dicts, oldest first across shards."""
+    limit = limit or EVENT_BATCH
+
+    def query(conn, index):
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, kind, user_id, payload, created_at FROM Events
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (after[index], limit))
+        return [{"id": id_, "shard": index, "kind": kind, "user_id": user_id, "created_at": created_at,
+                 **json.loads(payload)}
+                for id_, kind, user_id, payload, created_at in cursor.fetchall()]
+
+    # Each shard's events stay in id order, so the cursor can advance past any prefix of the merge.
+    merged = heapq.merge(*storage.fan_out(query, with_index=True), key=lambda event: event["created_at"])
+    return list(itertools.islice(merged, limit))
+
+
+def prune_events(days: int = None) -> int:
+    """Delete events older than `days` (default `keep_days()`) on every shard; returns the rows removed."""
+    cutoff = (datetime.now() - timedelta(days=keep_days() if days is None else days)).isoformat()
+
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM Events WHERE created_at < ?', (cutoff,))
+        conn.commit()
+        return cursor.rowcount
+
+    return sum(storage.fan_out(query))
+
+
+# --- Fan-out inside one process ---
+
+class EventHub:
+    """Polls Events from one background thread and fans new rows out to subscriber queues."""
+
+    def __init__(self, poll_interval: float = 1.0, max_queued: int = 1000):
+        self.poll_interval = poll_interval
+        self.max_queued = max_queued
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._cursor = None
+
+    def subscribe(self) -> queue.Queue:
+        subscriber = queue.Queue(self.max_queued)
+        with self._lock:
+            if not self._subscribers:
+                # Nobody was listening, so nothing was polled; start from the current end.
+                self._cursor = current_cursor()
+            self._subscribers.add(subscriber)
+            metrics.set_gauge(SUBSCRIBERS, len(self._subscribers))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="event-hub", daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            metrics.set_gauge(SUBSCRIBERS, len(self._subscribers))
+
+    def wake(self):
+        """Poll now instead of at the next interval (events published in this process)."""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            with self._lock:
+                subscribers = list(self._subscribers)
+            if not subscribers:
+                continue
+            try:
+                events = events_after(self._cursor)
+            except Exception as e:
+                logger.error(f"Event poll failed: {e}")
+                continue
+            if not events:
+                continue
+            for event in events:
+                self._cursor = advance(self._cursor, event)
+            if len(events) == EVENT_BATCH:
+                self._wakeup.set()
+            for subscriber in subscribers:
+                for event in events:
+                    try:
+                        subscriber.put_nowait(event)
+                    except queue.Full:
+                        # A stalled client is dropped; it replays from Last-Event-ID when it reconnects.
+                        self.unsubscribe(subscriber)
+                        with contextlib.suppress(queue.Empty):
+                            subscriber.get_nowait()
+                        subscriber.put_nowait(None)
+                        break
+
+
+HUB = EventHub()
@@ -0,0 +1,190 @@
+"""
+OpenAI calls shared by the bot and the dashboard.
+
+The `openai` package is imported and the client is built on the first call,
+so processes that never talk to the model (dashboard workers serving pages,
+maintenance scripts) do not pay for it.
+"""
+import functools
+import logging
+import time
+
+import metrics
+from core import usage
+from core.config import get_config
+
+logger = logging.getLogger(__name__)
+
+PROMPT_FILE = "promt.txt"
+MODEL = "gpt-3.5-turbo"
+
+
+_client_override = None
+
+
+def use_client(client):
+    """Send every completion to `client` instead of OpenAI (webhook replay runs against an offline one)."""
+    global _client_override
+    _client_override = client
+
+
+def get_client():
+    """The OpenAI client, created on first use."""
+    if _client_override is not None:
+        return _client_override
+    return _openai_client()
+
+
+@functools.lru_cache(maxsize=None)
+def _openai_client():
+    from openai import OpenAI
+
+    return OpenAI(api_key=get_config()['openai_api_key'])
+
+
+@functools.lru_cache(maxsize=None)
+def _system_prompt() -> str:
+    with open(PROMPT_FILE, "r") as f:
+        return f.read()
+
+
+def _complete(call: str, user_id, **request):
+    """Run a chat completion and record its tokens, latency and outcome (see core/usage.py)."""
+    metrics.inc(metrics.LLM_CALLS, call=call)
+    started = time.perf_counter()
+    try:
+        response = get_client().chat.completions.create(**request)
+    except Exception:
+        usage.record(user_id, call, request["model"], 0, 0, (time.perf_counter() - started) * 1000, "error")
+        raise
+    tokens = response.usage
+    usage.record(user_id, call, request["model"], getattr(tokens, "prompt_tokens", 0) or 0,
+                 getattr(tokens, "completion_tokens", 0) or 0, (time.perf_counter() - started) * 1000, "ok")
+    return response
+
+def _stream(call: str, user_id, **request):
+    """Streamed variant of `_complete`: yields text deltas and records usage when the stream ends."""
+    metrics.inc(metrics.LLM_CALLS, call=call)
+    started = time.perf_counter()
+    prompt_tokens = completion_tokens = 0
+    first_token = False
+    outcome = "error"
+    stream = None
+    try:
+        stream = get_client().chat.completions.create(stream=True, stream_options={"include_usage": True}, **request)
+        for chunk in stream:
+            if chunk.usage:
+                prompt_tokens = chunk.usage.prompt_tokens or 0
+                completion_tokens = chunk.usage.completion_tokens or 0
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                if not first_token:
+                    first_token = True
+                    metrics.observe(usage.TTFT, time.perf_counter() - started, call=call, model=request["model"])
+                yield delta
+        outcome = "ok"
+    finally:
+        # Also reached when the consumer closes this generator early: release the HTTP stream.
+        if stream is not None:
+            stream.close()
+        usage.record(user_id, call, request["model"], prompt_tokens, completion_tokens,
+                     (time.perf_counter() - started) * 1000, outcome)
+
+# --- Analysis ---
+
+@metrics.instrument("llm.analyze_user_messages")
+def analyze_user_messages(user_history: str, window_size: int = 10, user_id: int = None,
+                          model: str = MODEL) -> (bool, str):
+    messages_list = [msg.strip() for msg in user_history.split("\n") if msg.strip()]
+    if len(" ".join(messages_list).split()) < 50:
+        return (False, "Not enough data for analysis.")
+
+    recent_history = "\n".join(messages_list[-window_size:])
+    prompt = (
+        "Analyze the following user's conversation history for signs of psychological distress or indicators that "
+        "the user might benefit from psychological analysis. Give extra weight to the most recent messages. If the most recent "
+        "messages indicate improvement or resolution of previous issues, reflect that in your analysis. Respond with either:\n"
+        "'yes: <brief explanation>' if concern is detected, or\n"
+        "'no: <brief explanation>' if no concern is detected.\n\n"
+        "Recent conversation history:\n" + recent_history
+    )
+
+    response = _complete(
+        "analysis", user_id,
+        model=model,
+        messages=[
+            {"role": "system", "content": "Analyzing user conversation history."},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=100
+    )
+    result = response.choices[0].message.content.strip().lower()
+    if result.startswith("yes:"):
+        explanation = result[4:].strip()
+        return (True, explanation)
+    return (False, result[3:].strip() if result.startswith("no:") else result)
+
+@metrics.instrument("llm.get_mental_health_percentage")
+def get_mental_health_percentage(user_history: str, window_size: int = 10, user_id: int = None,
+                                 model: str = MODEL):
+    """
+    Use OpenAI's API to get a mental health risk percentage (0-100) based on the user's conversation history.
+    Expected output format: "NUMBER: CATEGORY" (e.g., "15: Green").
+    Returns (percent, category), or None when there is no score: too little history, or an unreadable answer.
+    """
+    messages_list = [msg.strip() for msg in user_history.split("\n") if msg.strip()]
+    # Without enough data there is no score; a placeholder 0% would read as a real one downstream.
+    if len(" ".join(messages_list).split()) < 50:
+        return None
+
+    recent_history = "\n".join(messages_list[-window_size:])
+    prompt = (
+        "Based on the following user's conversation history, provide a mental health risk percentage from 0 to 100. "
+        "0 means the user is completely okay, and 100 means extremely high risk. Then, assign a risk category as follows: "
+        "0-20: Green - you are okay, 20-40: Orange - a little problem, 40-60: Yellow - moderate concern, above 60: Red - immediate help needed. "
+        "Output your answer in the format: NUMBER: CATEGORY. For example, '15: Green'.\n\n"
+        "Conversation history:\n" + recent_history
+    )
+
+    response = _complete(
+         "mental_health", user_id,
+         model=model,
+         messages=[
+              {"role": "system", "content": "Analyze mental health risk."},
+              {"role": "user", "content": prompt}
+         ],
+         max_tokens=50
+    )
+    result = response.choices[0].message.content.strip()
+    try:
+         parts = result.split(":")
+         percent = float(parts[0].strip())
+         category = parts[1].strip() if len(parts) > 1 else ""
+         return (percent, category)
+    except Exception as e:
+         logger.error(f"Error parsing mental health analysis: {e}. Response was: {result}")
+         return None
+
+# --- Conversational Replies ---
+
+def _reply_request(user_message: str) -> dict:
+    return dict(
+         model=MODEL,
+         messages=[
+            {"role": "system", "content": _system_prompt()},
+            {"role": "user", "content": user_message}
+         ],
+         max_tokens=150,
+         temperature=0.7,
+         top_p=1
+    )
+
+@metrics.instrument("llm.get_ai_response")
+def get_ai_response(user_message: str, user_id: int = None) -> str:
+    """Generate a conversational reply using GPT-3.5-turbo."""
+    response = _complete("reply", user_id, **_reply_request(user_message))
+    return response.choices[0].message.content.strip()
+
+def stream_ai_response(user_message: str, user_id: int = None):
+    """Same reply as `get_ai_response`, as a blocking iterator of text deltas (see reply_stream.py)."""
+    return _stream("reply", user_id, **_reply_request(user_message))
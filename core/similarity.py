@@ -0,0 +1,366 @@
+"""
+Offline embedding index of users' conversations for "similar users" search.
+
+Messages are embedded with a signed hashing vectorizer (word unigrams and
+bigrams into DIM buckets), so nothing is downloaded or trained. Each user is
+represented by an exponentially decayed sum of their message vectors, which
+acts as a sliding window over roughly the last `half_life` messages and can
+be updated one message at a time.
+
+The user vectors live in a float32 memory-mapped matrix next to the database
+and are updated incrementally from the last message id seen on each shard.
+Messages are read and folded in batches of REFRESH_BATCH, saving the position
+after each one, so a first build needs memory for one batch only and resumes
+where it stopped. Top-k queries are one batched matrix product over the whole
+matrix, taken under the same lock as each batch's update.
+
+The index is built with the command below, never inside a request; until then
+`built()` is False and the dashboard says so. Once built, queries start an
+incremental refresh in a background thread and answer from the current state.
+
+numpy is optional: without it `available()` is False and the dashboard hides
+the similar-users panel.
+
+    python -m core.similarity --rebuild
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - optional dependency
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+import metrics
+import storage
+from core.config import get_config
+
+logger = logging.getLogger(__name__)
+
+DIM = 256
+# Messages read, embedded and saved per step of a refresh.
+REFRESH_BATCH = 20000
+DEFAULT_OPTIONS = {
+    # Files are <path>.f32 (vectors), <path>.ids.npy (row -> user_id) and <path>.json (state).
+    "path": "user_embeddings",
+    # A message's weight halves after this many newer messages from the same user.
+    "half_life": 50,
+    # Minimum seconds between incremental refreshes triggered by queries.
+    "refresh_seconds": 10,
+}
+
+_TOKEN = re.compile(r"\w+")
+
+metrics.describe("analyzebot_similarity_users", "Users in the embedding index.")
+
+
+def available() -> bool:
+    return np is not None
+
+
+def _options() -> dict:
+    return dict(DEFAULT_OPTIONS, **(get_config().get('similarity') or {}))
+
+
+# --- Vectorizer ---
+
+def _features(text: str) -> list:
+    words = _TOKEN.findall(text.casefold())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def embed_texts(texts) -> "np.ndarray":
+    """Embed texts into L2-normalized DIM-dimensional float32 rows."""
+    rows, columns, signs = [], [], []
+    for row, text in enumerate(texts):
+        for feature in _features(text or ""):
+            h = zlib.crc32(feature.encode("utf-8"))
+            rows.append(row)
+            columns.append(h % DIM)
+            signs.append(1.0 if h & 0x80000000 else -1.0)
+    vectors = np.zeros((len(texts), DIM), dtype=np.float32)
+    np.add.at(vectors, (np.array(rows, dtype=np.intp), np.array(columns, dtype=np.intp)),
+              np.array(signs, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+# --- Index ---
+
+class UserIndex:
+    """Memory-mapped user vectors plus the row of every user_id."""
+
+    def __init__(self, path: str, half_life: float):
+        self.path = path
+        self.decay = 0.5 ** (1.0 / half_life)
+        self.vectors = None
+        self.norms = None
+        self.user_ids = None
+        self.rows = {}
+        self.count = 0
+        self.last_ids = []
+        self._state_mtime = None
+        # Guards the in-memory state; held by queries and by each refresh batch, never across a whole refresh.
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+
+    # Files
+
+    def _load(self):
+        """(Re)load the on-disk state if another process or an earlier run changed it."""
+        state_file = self.path + ".json"
+        if not os.path.exists(state_file):
+            if self.vectors is None:
+                self._reset()
+            return
+        mtime = os.path.getmtime(state_file)
+        if mtime == self._state_mtime:
+            return
+        with open(state_file, "r") as file:
+            state = json.load(file)
+        if state.get("dim") != DIM:
+            logger.warning("Embedding index was built with another dimension; rebuilding")
+            self._reset()
+            return
+        self.count = state["count"]
+        self.last_ids = state["last_ids"]
+        self.vectors = np.memmap(self.path + ".f32", dtype=np.float32, mode="r+", shape=(state["capacity"], DIM))
+        self.user_ids = np.load(self.path + ".ids.npy")
+        self.rows = {int(user_id): row for row, user_id in enumerate(self.user_ids[:self.count])}
+        self.norms = np.linalg.norm(self.vectors[:self.count], axis=1)
+        self._state_mtime = mtime
+
+    def load(self):
+        """Pick up the on-disk state; cheap when it has not changed."""
+        with self._lock:
+            self._load()
+
+    def _reset(self):
+        self.count = 0
+        self.last_ids = []
+        self.rows = {}
+        self.user_ids = np.zeros(0, dtype=np.int64)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self._allocate(1024)
+
+    def _allocate(self, capacity: int):
+        """Create a memmap with room for `capacity` users, keeping the current rows."""
+        tmp_file = self.path + ".f32.tmp"
+        vectors = np.memmap(tmp_file, dtype=np.float32, mode="w+", shape=(capacity, DIM))
+        if self.vectors is not None and self.count:
+            vectors[:self.count] = self.vectors[:self.count]
+        vectors.flush()
+        del vectors
+        os.replace(tmp_file, self.path + ".f32")
+        self.vectors = np.memmap(self.path + ".f32", dtype=np.float32, mode="r+", shape=(capacity, DIM))
+
+    def _save(self, ids_changed: bool):
+        self.vectors.flush()
+        if ids_changed:
+            np.save(self.path + ".ids.npy", self.user_ids[:self.count])
+        state_file = self.path + ".json"
+        with open(state_file + ".tmp", "w") as file:
+            json.dump({"dim": DIM, "count": self.count, "capacity": self.vectors.shape[0],
+                       "last_ids": self.last_ids}, file)
+        os.replace(state_file + ".tmp", state_file)
+        self._state_mtime = os.path.getmtime(state_file)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        # One writer at a time across dashboard workers; readers only need the in-memory copy.
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Updates
+
+    def refresh(self, batch_size: int = REFRESH_BATCH) -> int:
+        """Fold messages newer than the last seen id of each shard into the index; returns messages added."""
+        with self._refresh_lock, self._file_lock():
+            with self._lock:
+                self._load()
+                shard_count = storage.backend().shard_count
+                if len(self.last_ids) != shard_count:
+                    self._reset()
+                    self.last_ids = [0] * shard_count
+            added = 0
+            for index in range(shard_count):
+                conn = storage.backend().connect_shard(index)
+                try:
+                    while True:
+                        cursor = conn.cursor()
+                        cursor.execute('''
+                            SELECT id, user_id, content FROM Messages
+                            WHERE id > ? AND user_id IS NOT NULL
+                            ORDER BY id
+                            LIMIT ?
+                        ''', (self.last_ids[index], batch_size))
+                        rows = cursor.fetchall()
+                        if not rows:
+                            break
+                        # Embedding is the slow part and touches no shared state, so queries keep running.
+                        message_vectors = embed_texts([content for _, _, content in rows])
+                        with self._lock:
+                            ids_changed = self._add(rows, message_vectors)
+                            self.last_ids[index] = rows[-1][0]
+                            self._save(ids_changed)
+                        added += len(rows)
+                        if len(rows) < batch_size:
+                            break
+                        logger.info(f"Indexed shard {index} up to message id {rows[-1][0]} ({self.count} users)")
+                finally:
+                    conn.close()
+            metrics.set_gauge("analyzebot_similarity_users", self.count)
+            return added
+
+    def _add(self, rows, message_vectors) -> bool:
+        """Apply (id, user_id, content) rows, oldest first, with their embeddings; True when users were added."""
+        user_ids = [user_id for _, user_id, _ in rows]
+        new_users = list(dict.fromkeys(u for u in user_ids if u not in self.rows))
+        if new_users:
+            needed = self.count + len(new_users)
+            if needed > self.vectors.shape[0]:
+                self._allocate(max(needed, 2 * self.vectors.shape[0]))
+            self.user_ids = np.concatenate([self.user_ids[:self.count], np.array(new_users, dtype=np.int64)])
+            self.norms = np.concatenate([self.norms[:self.count], np.zeros(len(new_users), dtype=np.float32)])
+            for user_id in new_users:
+                self.rows[user_id] = self.count
+                self.count += 1
+
+        user_rows = np.array([self.rows[u] for u in user_ids], dtype=np.intp)
+        # Each message is weighted by decay ** (number of newer messages from the same user in this batch).
+        newer = np.zeros(len(rows), dtype=np.float32)
+        seen = {}
+        for i in range(len(rows) - 1, -1, -1):
+            newer[i] = seen.get(user_rows[i], 0)
+            seen[user_rows[i]] = newer[i] + 1
+        touched = np.fromiter(seen.keys(), dtype=np.intp, count=len(seen))
+        per_user = np.fromiter(seen.values(), dtype=np.float32, count=len(seen))
+        self.vectors[touched] *= (self.decay ** per_user)[:, None]
+        np.add.at(self.vectors, user_rows, message_vectors * (self.decay ** newer)[:, None])
+        self.norms[touched] = np.linalg.norm(self.vectors[touched], axis=1)
+        return bool(new_users)
+
+    # Queries
+
+    def similar_to(self, user_ids, k: int) -> dict:
+        """{user_id: [(other_user_id, score), ...]} for `user_ids`, from one consistent state."""
+        with self._lock:
+            rows = [self.rows[u] for u in user_ids if u in self.rows]
+            if not rows:
+                return {u: [] for u in user_ids}
+            rows = np.array(rows, dtype=np.intp)
+            matches = self._top_k(np.array(self.vectors[rows]), k, rows)
+            found = {int(self.user_ids[row]): result for row, result in zip(rows, matches)}
+        return {u: found.get(u, []) for u in user_ids}
+
+    def top_k(self, queries: "np.ndarray", k: int, exclude_rows=None):
+        """Cosine top-k for each query row; returns a list of [(user_id, score), ...]."""
+        with self._lock:
+            return self._top_k(queries, k, exclude_rows)
+
+    def _top_k(self, queries, k, exclude_rows):
+        count = self.count
+        if count == 0:
+            return [[] for _ in range(len(queries))]
+        matrix = self.vectors[:count]
+        norms = self.norms[:count]
+        query_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = np.divide(queries, query_norms, out=np.zeros_like(queries), where=query_norms > 0)
+        scores = queries @ matrix.T
+        np.divide(scores, norms, out=scores, where=norms > 0)
+        scores[:, norms == 0] = -np.inf
+        if exclude_rows is not None:
+            scores[np.arange(len(queries)), exclude_rows] = -np.inf
+        k = min(k, count)
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for q, candidates in enumerate(best):
+            ordered = candidates[np.argsort(-scores[q, candidates])]
+            # Scores <= 0 share nothing with the query (or point away from it); they are not matches.
+            results.append([(int(self.user_ids[row]), float(scores[q, row]))
+                            for row in ordered if scores[q, row] > 0])
+        return results
+
+
+_index = None
+_index_lock = threading.Lock()
+_refresh_running = threading.Lock()
+_last_refresh = 0.0
+
+
+def built() -> bool:
+    """True once the index has been built with `python -m core.similarity`."""
+    return os.path.exists(_options()["path"] + ".json")
+
+
+def _refresh_in_background():
+    if not _refresh_running.acquire(blocking=False):
+        return
+    try:
+        _index.refresh()
+    except Exception as e:
+        logger.error(f"Similarity index refresh failed: {e}")
+    finally:
+        _refresh_running.release()
+
+
+def get_index(refresh: bool = True) -> UserIndex:
+    """The process-wide index; a built index is refreshed in the background at most every `refresh_seconds`."""
+    global _index, _last_refresh
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                options = _options()
+                _index = UserIndex(options["path"], options["half_life"])
+    if refresh and built():
+        _index.load()
+        if time.monotonic() - _last_refresh >= _options()["refresh_seconds"]:
+            _last_refresh = time.monotonic()
+            threading.Thread(target=_refresh_in_background, name="similarity-refresh", daemon=True).start()
+    return _index
+
+
+def similar_users(user_ids, k: int = 10) -> dict:
+    """Return {user_id: [(other_user_id, score), ...]} for every indexed user in `user_ids` (check `built()` first)."""
+    return get_index().similar_to(user_ids, k)
+
+
+def search_users(text: str, k: int = 10) -> list:
+    """Users whose recent conversation is closest to `text` (check `built()` first)."""
+    return get_index().top_k(embed_texts([text]), k)[0]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build or update the user embedding index")
+    parser.add_argument('--rebuild', action='store_true', help="discard the index and embed every message again")
+    args = parser.parse_args()
+    if not available():
+        raise SystemExit("numpy is required: pip install numpy")
+    index = get_index(refresh=False)
+    if args.rebuild:
+        for suffix in (".json", ".ids.npy"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(index.path + suffix)
+    started = time.perf_counter()
+    added = index.refresh()
+    print(f"Indexed {added} messages for {index.count} users in {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,269 @@
+"""
+Token, latency and cost accounting for OpenAI calls, and daily budgets.
+
+core/llm.py reports every completion here. Records are queued in memory and
+written to the LLMUsage table in batches by a background thread, so the call
+path never waits on the database.
+
+Budgets are set under `llm_budget` in config.json; every limit is optional:
+
+    "llm_budget": {"daily_tokens": 500000, "daily_cost_usd": 2.0, "daily_tokens_per_user": 20000,
+                   "downgrade_at": 0.8, "downgrade_model": "gpt-4o-mini", "downgrade_window": 4}
+
+Past `downgrade_at` of any limit, background analysis runs with the cheaper
+settings; past the limit itself it is skipped. Replies are never limited.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import metrics
+import storage
+from core.config import get_config
+
+logger = logging.getLogger(__name__)
+
+FULL = "full"
+DOWNGRADE = "downgrade"
+SKIP = "skip"
+
+# USD per 1K tokens (prompt, completion); extend or override with `llm_prices` in config.json.
+DEFAULT_PRICES = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+}
+
+TOKENS = "analyzebot_llm_tokens_total"
+COST = "analyzebot_llm_cost_usd_total"
+LATENCY = "analyzebot_llm_latency_seconds"
+BUDGET_DECISIONS = "analyzebot_llm_budget_decisions_total"
+TTFT = "analyzebot_llm_time_to_first_token_seconds"
+metrics.describe(TOKENS, "Tokens used by OpenAI calls, by call type and kind (prompt/completion).")
+metrics.describe(COST, "Estimated OpenAI spend in USD, by call type.")
+metrics.describe(LATENCY, "OpenAI completion latency in seconds, by call type and model.")
+metrics.describe(TTFT, "Time from request to the first streamed token, by call type and model.")
+metrics.describe(BUDGET_DECISIONS, "Background analyses run downgraded or skipped because of the daily budget.")
+
+USAGE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS LLMUsage (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        call_type TEXT,
+        model TEXT,
+        prompt_tokens INTEGER,
+        completion_tokens INTEGER,
+        cost_usd REAL,
+        latency_ms REAL,
+        outcome TEXT,
+        created_at TEXT
+    )
+'''
+USAGE_INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_llmusage_time ON LLMUsage (created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_llmusage_user_time ON LLMUsage (user_id, created_at)',
+)
+
+
+def cost_usd(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prices = dict(DEFAULT_PRICES, **{name: tuple(p) for name, p in (get_config().get('llm_prices') or {}).items()})
+    prompt_price, completion_price = prices.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+# --- Recording ---
+
+class UsageRecorder:
+    """Queues usage records and writes them with executemany from one background thread."""
+
+    def __init__(self, flush_interval: float = 2.0, batch_size: int = 200):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._batch_ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def record(self, user_id, call: str, model: str, prompt_tokens: int, completion_tokens: int,
+               latency_ms: float, outcome: str):
+        cost = cost_usd(model, prompt_tokens, completion_tokens)
+        self._queue.put((user_id, call, model, prompt_tokens, completion_tokens, cost, latency_ms, outcome,
+                         datetime.now().isoformat()))
+        metrics.inc(TOKENS, prompt_tokens, call=call, kind="prompt")
+        metrics.inc(TOKENS, completion_tokens, call=call, kind="completion")
+        metrics.inc(COST, cost, call=call)
+        if outcome != "skipped":
+            metrics.observe(LATENCY, latency_ms / 1000, call=call, model=model)
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="llm-usage", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def flush(self):
+        """Write everything queued so far."""
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return
+        try:
+            conn = storage.connect()
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO LLMUsage (user_id, call_type, model, prompt_tokens, completion_tokens, cost_usd,
+                                      latency_ms, outcome, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Could not write {len(rows)} LLM usage records: {e}")
+
+    def _run(self):
+        while True:
+            self._batch_ready.wait(self.flush_interval)
+            self._batch_ready.clear()
+            self.flush()
+
+
+RECORDER = UsageRecorder()
+record = RECORDER.record
+
+
+def record_skipped(user_id, call: str):
+    """Note a call that the budget prevented, so the dashboard shows what was not analyzed."""
+    record(user_id, call, "", 0, 0, 0.0, "skipped")
+
+
+# --- Budgets ---
+
+_totals_cache = {}
+_TOTALS_TTL = 15.0
+
+
+def _today_totals(user_id=None):
+    """(tokens, cost) used today, overall or for one user; cached for a few seconds."""
+    key = user_id
+    cached = _totals_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    since = datetime.now().date().isoformat()
+    conn = storage.connect()
+    cursor = conn.cursor()
+    if user_id is None:
+        cursor.execute('''
+            SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0), COALESCE(SUM(cost_usd), 0)
+            FROM LLMUsage WHERE created_at >= ?
+        ''', (since,))
+    else:
+        cursor.execute('''
+            SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0), COALESCE(SUM(cost_usd), 0)
+            FROM LLMUsage WHERE user_id = ? AND created_at >= ?
+        ''', (user_id, since))
+    totals = cursor.fetchone()
+    conn.close()
+    _totals_cache[key] = (time.monotonic() + _TOTALS_TTL, totals)
+    if len(_totals_cache) > 10000:
+        _totals_cache.clear()
+    return totals
+
+
+def budget_usage(user_id=None) -> list:
+    """Return (limit name, used, limit) for every configured daily limit."""
+    budget = get_config().get('llm_budget') or {}
+    usage = []
+    if budget.get('daily_tokens') or budget.get('daily_cost_usd'):
+        tokens, cost = _today_totals()
+        if budget.get('daily_tokens'):
+            usage.append(("daily_tokens", tokens, budget['daily_tokens']))
+        if budget.get('daily_cost_usd'):
+            usage.append(("daily_cost_usd", cost, budget['daily_cost_usd']))
+    if user_id is not None and budget.get('daily_tokens_per_user'):
+        usage.append(("daily_tokens_per_user", _today_totals(user_id)[0], budget['daily_tokens_per_user']))
+    return usage
+
+
+def budget_mode(user_id=None) -> str:
+    """FULL, DOWNGRADE or SKIP for background analysis of `user_id` under today's budgets."""
+    budget = get_config().get('llm_budget') or {}
+    try:
+        usage = budget_usage(user_id)
+    except Exception as e:
+        logger.error(f"Could not read LLM usage, running analysis without budget: {e}")
+        return FULL
+    fractions = [used / limit for _, used, limit in usage]
+    if any(f >= 1 for f in fractions):
+        mode = SKIP
+    elif any(f >= budget.get('downgrade_at', 0.8) for f in fractions):
+        mode = DOWNGRADE
+    else:
+        return FULL
+    metrics.inc(BUDGET_DECISIONS, mode=mode)
+    return mode
+
+
+def downgrade_options() -> dict:
+    """Keyword arguments for the analysis functions when running downgraded."""
+    budget = get_config().get('llm_budget') or {}
+    options = {"window_size": budget.get('downgrade_window', 4)}
+    if budget.get('downgrade_model'):
+        options["model"] = budget['downgrade_model']
+    return options
+
+
+# --- Rollups for the dashboard ---
+
+def _rollup(sql: str, parameters=()) -> list:
+    conn = storage.connect()
+    cursor = conn.cursor()
+    cursor.execute(sql, parameters)
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+
+def daily_rollup(days: int = 30) -> list:
+    """(day, calls, prompt_tokens, completion_tokens, cost_usd, avg_latency_ms, errors, skipped), newest first."""
+    since = (datetime.now() - timedelta(days=days)).date().isoformat()
+    return _rollup('''
+        SELECT SUBSTR(created_at, 1, 10) AS day, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens),
+               SUM(cost_usd), AVG(CASE WHEN outcome != 'skipped' THEN latency_ms END),
+               SUM(CASE WHEN outcome = 'error' THEN 1 ELSE 0 END),
+               SUM(CASE WHEN outcome = 'skipped' THEN 1 ELSE 0 END)
+        FROM LLMUsage WHERE created_at >= ?
+        GROUP BY day ORDER BY day DESC
+    ''', (since,))
+
+
+def call_rollup(days: int = 30) -> list:
+    """(call_type, model, calls, prompt_tokens, completion_tokens, cost_usd, avg_latency_ms, max_latency_ms), by cost."""
+    since = (datetime.now() - timedelta(days=days)).date().isoformat()
+    return _rollup('''
+        SELECT call_type, model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost_usd),
+               AVG(latency_ms), MAX(latency_ms)
+        FROM LLMUsage WHERE created_at >= ? AND outcome != 'skipped'
+        GROUP BY call_type, model ORDER BY SUM(cost_usd) DESC
+    ''', (since,))
+
+
+def user_rollup(days: int = 30, limit: int = 50) -> list:
+    """(user_id, calls, tokens, tokens_today, cost_usd, avg_latency_ms) for the heaviest users."""
+    since = (datetime.now() - timedelta(days=days)).date().isoformat()
+    today = datetime.now().date().isoformat()
+    return _rollup('''
+        SELECT user_id, COUNT(*), SUM(prompt_tokens + completion_tokens),
+               SUM(CASE WHEN created_at >= ? THEN prompt_tokens + completion_tokens ELSE 0 END),
+               SUM(cost_usd), AVG(latency_ms)
+        FROM LLMUsage WHERE created_at >= ? AND outcome != 'skipped'
+        GROUP BY user_id ORDER BY SUM(prompt_tokens + completion_tokens) DESC
+        LIMIT ?
+    ''', (today, since, limit))
@@ -0,0 +1,132 @@
+"""
+Ingress filtering in front of message_handler.
+
+Every accepted text costs two DB writes and three OpenAI calls, so floods and
+repeated messages are stopped before that work starts. Each message is run
+through three rules, cheapest first:
+
+- invalid: the character whitelist (precompiled);
+- rate_limit: a per-user token bucket;
+- duplicate: the same normalized text from the same user within a short window.
+
+Each rule has an action: "drop" (ignore the message), "store_only" (save it
+to the database but skip analysis and the reply) or "full" (let it through).
+"""
+import hashlib
+import re
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+DROP = "drop"
+STORE_ONLY = "store_only"
+FULL = "full"
+
+FILTERED = "analyzebot_ingress_filtered_total"
+ACCEPTED = "analyzebot_ingress_accepted_total"
+metrics.describe(FILTERED, "Messages caught by an ingress rule, by rule and action.")
+metrics.describe(ACCEPTED, "Messages that passed every ingress rule.")
+
+VALID_INPUT = re.compile(r'^[A-Za-z\u0400-\u04FF0-9\s\|\]\[\+=\-@#.,!?;:()\'\"—]+$')
+_NON_WORD = re.compile(r'[\W_]+')
+_REPEATED_CHAR = re.compile(r'(.)\1+')
+
+DEFAULT_RULES = {
+    "invalid": {"action": DROP},
+    "rate_limit": {"action": DROP, "capacity": 5, "refill_per_second": 0.2},
+    "duplicate": {"action": STORE_ONLY, "window_seconds": 60},
+}
+
+
+def is_valid_input(user_input: str) -> bool:
+    return bool(VALID_INPUT.match(user_input))
+
+
+def normalized_hash(text: str) -> bytes:
+    """Hash of the text with case, punctuation, spacing and stretched letters ("sooooo") removed."""
+    text = _NON_WORD.sub(" ", text.casefold())
+    text = _REPEATED_CHAR.sub(r"\1", text)
+    return hashlib.blake2b(" ".join(text.split()).encode("utf-8"), digest_size=8).digest()
+
+
+class _BoundedUserState(OrderedDict):
+    """Per-user state that forgets the least recently active users beyond `max_users`."""
+
+    def __init__(self, max_users: int):
+        super().__init__()
+        self.max_users = max_users
+
+    def touch(self, user_id, default_factory):
+        state = self.get(user_id)
+        if state is None:
+            state = self[user_id] = default_factory()
+            if len(self) > self.max_users:
+                self.popitem(last=False)
+        else:
+            self.move_to_end(user_id)
+        return state
+
+
+class TokenBucket:
+    """Per-user token bucket: `capacity` messages in a burst, refilled at `refill_per_second`."""
+
+    def __init__(self, capacity: float, refill_per_second: float, max_users: int = 100000):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._buckets = _BoundedUserState(max_users)
+
+    def allow(self, user_id, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.touch(user_id, lambda: [self.capacity, now])
+        tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill_per_second)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+
+class DuplicateFilter:
+    """Remembers hashes of each user's recent messages for `window_seconds`."""
+
+    def __init__(self, window_seconds: float, max_users: int = 100000):
+        self.window_seconds = window_seconds
+        self._recent = _BoundedUserState(max_users)
+
+    def seen(self, user_id, text: str, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        recent = self._recent.touch(user_id, deque)
+        while recent and recent[0][0] < now - self.window_seconds:
+            recent.popleft()
+        digest = normalized_hash(text)
+        duplicate = any(h == digest for _, h in recent)
+        recent.append((now, digest))
+        return duplicate
+
+
+class IngressGate:
+    """Applies the ingress rules and returns the action to take for a message."""
+
+    def __init__(self, rules: dict = None):
+        self.rules = {name: dict(DEFAULT_RULES[name], **(rules or {}).get(name, {})) for name in DEFAULT_RULES}
+        rate = self.rules["rate_limit"]
+        self.bucket = TokenBucket(rate["capacity"], rate["refill_per_second"])
+        self.duplicates = DuplicateFilter(self.rules["duplicate"]["window_seconds"])
+
+    def check(self, user_id, text: str):
+        """Return (action, rule) for the first rule that fires with a non-"full" action."""
+        checks = (
+            ("invalid", lambda: not is_valid_input(text)),
+            ("rate_limit", lambda: not self.bucket.allow(user_id)),
+            ("duplicate", lambda: self.duplicates.seen(user_id, text)),
+        )
+        for rule, fired in checks:
+            if fired():
+                action = self.rules[rule]["action"]
+                metrics.inc(FILTERED, rule=rule, action=action)
+                if action != FULL:
+                    return action, rule
+        metrics.inc(ACCEPTED)
+        return FULL, None
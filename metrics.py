@@ -0,0 +1,221 @@
+"""
+Lightweight in-process metrics for the bot and the dashboard.
+
+Counters, gauges and latency histograms are kept in a single process-wide
+registry and rendered in the Prometheus text exposition format. Recording a
+sample is a dict lookup plus a short critical section, so the instrumentation
+is cheap enough to stay enabled in production.
+"""
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds: from fast SQLite lookups up to slow LLM round-trips.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGE_LATENCY = "analyzebot_stage_latency_seconds"
+STAGE_ERRORS = "analyzebot_stage_errors_total"
+LLM_CALLS = "analyzebot_llm_calls_total"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    """Thread-safe store of counters, gauges and histograms keyed by name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._callbacks = {}
+        self._help = {}
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def add_gauge(self, name: str, delta: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def gauge_callback(self, name: str, func, **labels):
+        """Register a function whose return value is sampled at scrape time (e.g. queue sizes)."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._callbacks[key] = func
+
+    def observe(self, name: str, value: float, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = _Histogram(buckets)
+            hist.observe(value)
+
+    def snapshot(self) -> dict:
+        """Return a plain copy of all current values, for JSON dumps and tests."""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: (list(h.buckets), list(h.counts), h.total, h.count)
+                          for key, h in self._histograms.items()}
+            callbacks = dict(self._callbacks)
+        for key, func in callbacks.items():
+            try:
+                gauges[key] = func()
+            except Exception:
+                continue
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        snap = self.snapshot()
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(snap["counters"].items()):
+            header(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), value in sorted(snap["gauges"].items()):
+            header(name, "gauge")
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), (buckets, counts, total, count) in sorted(snap["histograms"].items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                le = labels + (("le", _format_value(bound)),)
+                lines.append(f"{name}_bucket{_format_labels(le)} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# --- Process-wide registry and helpers ---
+
+REGISTRY = Registry()
+REGISTRY.describe(STAGE_LATENCY, "Latency of an instrumented stage in seconds.")
+REGISTRY.describe(STAGE_ERRORS, "Number of exceptions raised by an instrumented stage.")
+REGISTRY.describe(LLM_CALLS, "Number of OpenAI completion calls by call type.")
+
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+set_gauge = REGISTRY.set_gauge
+add_gauge = REGISTRY.add_gauge
+gauge_callback = REGISTRY.gauge_callback
+describe = REGISTRY.describe
+render = REGISTRY.render
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block of code as `stage`, counting it as an error if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        REGISTRY.inc(STAGE_ERRORS, stage=stage)
+        raise
+    finally:
+        REGISTRY.observe(STAGE_LATENCY, time.perf_counter() - start, stage=stage)
+
+
+def instrument(stage: str):
+    """Decorator version of `span` that works for both plain and async functions."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Side endpoint for processes without a web framework (the bot) ---
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes happen every few seconds; keep them out of the bot log.
+        pass
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve GET /metrics from a daemon thread and return the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return server
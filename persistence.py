@@ -0,0 +1,237 @@
+"""
+SQLite persistence for the bot's conversation state and user data.
+
+The `/start` authorization flow keeps partial answers in `context.user_data`
+and its position in the ConversationHandler. `SQLitePersistence` stores both
+in the main database (see storage.py) next to the other tables, so restarts
+do not lose them:
+
+- user data is loaded lazily, the first time an update arrives for a user,
+  instead of reading every row at startup;
+- writes requested in one persistence round are coalesced into a single
+  transaction;
+- flows untouched for longer than the TTL are evicted from memory and from
+  the database, so abandoned registrations do not pile up.
+
+In webhook mode several worker processes share the tables, and each user's
+updates reach only one of them. A process therefore only evicts the
+conversations it changed itself, and the row is deleted only if no other
+process has updated it within the TTL.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60
+
+
+class SQLitePersistence(BasePersistence):
+    """Persist user_data and conversation states in the BotUserData/BotConversations tables."""
+
+    def __init__(self, ttl: float = DEFAULT_TTL, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.ttl = ttl
+        self._loaded_users = set()
+        self._user_seen = {}
+        self._conversation_seen = {}
+        self._pending_users = {}
+        self._pending_conversations = {}
+        # (name, key) -> cutoff of conversations this process evicted; their rows are deleted only if still idle.
+        self._evicted_conversations = {}
+        self._write_task = None
+
+    # --- Reads ---
+
+    async def get_user_data(self):
+        # Loaded per user in refresh_user_data.
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._user_seen[user_id] = time.time()
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        if user_id in self._pending_users:
+            return
+        stored = await asyncio.to_thread(self._load_user, user_id)
+        if stored:
+            # Values set by the current update win over the stored copy.
+            user_data.update({k: v for k, v in stored.items() if k not in user_data})
+
+    async def get_conversations(self, name):
+        rows = await asyncio.to_thread(self._load_conversations, name)
+        conversations = {}
+        for conv_key, state, _updated_at in rows:
+            # Not tracked for eviction: another worker may own this conversation.
+            conversations[tuple(json.loads(conv_key))] = json.loads(state)
+        return conversations
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- Writes (coalesced) ---
+
+    async def update_user_data(self, user_id, data):
+        self._user_seen[user_id] = time.time()
+        self._pending_users[user_id] = data or None
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.discard(user_id)
+        self._user_seen.pop(user_id, None)
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self._conversation_seen.pop((name, key), None)
+        else:
+            self._conversation_seen[(name, key)] = time.time()
+            self._evicted_conversations.pop((name, key), None)
+        self._pending_conversations[(name, key)] = new_state
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        self._write_pending()
+
+    def _schedule_write(self):
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write_soon())
+
+    async def _write_soon(self):
+        # Yield once so every update_* call from the same persistence round joins the batch.
+        await asyncio.sleep(0)
+        await asyncio.to_thread(self._write_pending)
+
+    # --- Eviction ---
+
+    async def evict_expired(self, application):
+        """Drop user data and conversation states not touched within the TTL."""
+        cutoff = time.time() - self.ttl
+        idle_users = [user_id for user_id, seen in self._user_seen.items() if seen < cutoff]
+        for user_id in idle_users:
+            application.drop_user_data(user_id)
+        expired = [name_key for name_key, seen in self._conversation_seen.items() if seen < cutoff]
+        # python-telegram-bot offers no public way to end a conversation from outside a handler;
+        # removing the key from the tracked dict ends it and reports the removal back to us.
+        tracked = getattr(application, '_conversation_handler_conversations', {})
+        for name, key in expired:
+            self._evicted_conversations[(name, key)] = cutoff
+            if name in tracked:
+                tracked[name].pop(key, None)
+            self._conversation_seen.pop((name, key), None)
+        await asyncio.to_thread(self._delete_expired, cutoff)
+        if idle_users or expired:
+            logger.info(f"Evicted {len(idle_users)} idle user records and {len(expired)} abandoned conversations")
+
+    async def run_eviction(self, application, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict_expired(application)
+            except Exception as e:
+                logger.error(f"Persistence eviction failed: {e}")
+
+    # --- Database access ---
+
+    def _load_user(self, user_id):
+        conn = storage.connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT data, updated_at FROM BotUserData WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None or row[1] < time.time() - self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def _load_conversations(self, name):
+        cutoff = time.time() - self.ttl
+        conn = storage.connect()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM BotConversations WHERE name = ? AND updated_at < ?", (name, cutoff))
+        cursor.execute("SELECT conv_key, state, updated_at FROM BotConversations WHERE name = ?", (name,))
+        rows = cursor.fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def _write_pending(self):
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        evicted = {name_key: self._evicted_conversations.pop(name_key)
+                   for name_key in conversations if name_key in self._evicted_conversations}
+        if not users and not conversations:
+            return
+        now = time.time()
+        conn = storage.connect()
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT OR REPLACE INTO BotUserData (user_id, data, updated_at) VALUES (?, ?, ?)",
+            [(user_id, json.dumps(data, ensure_ascii=False), now) for user_id, data in users.items() if data]
+        )
+        cursor.executemany(
+            "DELETE FROM BotUserData WHERE user_id = ?",
+            [(user_id,) for user_id, data in users.items() if not data]
+        )
+        cursor.executemany(
+            "INSERT OR REPLACE INTO BotConversations (name, conv_key, state, updated_at) VALUES (?, ?, ?, ?)",
+            [(name, json.dumps(key), json.dumps(state), now)
+             for (name, key), state in conversations.items() if state is not None]
+        )
+        cursor.executemany(
+            "DELETE FROM BotConversations WHERE name = ? AND conv_key = ?",
+            [(name, json.dumps(key)) for (name, key), state in conversations.items()
+             if state is None and (name, key) not in evicted]
+        )
+        # An evicted conversation may have moved on in another process since; keep it if so.
+        cursor.executemany(
+            "DELETE FROM BotConversations WHERE name = ? AND conv_key = ? AND updated_at < ?",
+            [(name, json.dumps(key), cutoff) for (name, key), cutoff in evicted.items()
+             if conversations[(name, key)] is None]
+        )
+        conn.commit()
+        conn.close()
+
+    def _delete_expired(self, cutoff):
+        conn = storage.connect()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM BotUserData WHERE updated_at < ?", (cutoff,))
+        cursor.execute("DELETE FROM BotConversations WHERE updated_at < ?", (cutoff,))
+        conn.commit()
+        conn.close()
@@ -0,0 +1,238 @@
+"""
+Statement-level profiling for the SQLite access in the bot and the dashboard.
+
+Connections opened through `connect()` time every statement (execute plus the
+fetches that follow it) and aggregate the samples by a normalized fingerprint.
+Statements slower than the configured threshold get their `EXPLAIN QUERY PLAN`
+captured so full table scans are visible, and a per-request scope records how
+often the same fingerprint repeats within one page load to expose N+1 loops.
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_SLOW_MS = 50.0
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(sql: str) -> str:
+    """Normalize a statement so calls that differ only in literals share one entry."""
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _IN_LIST.sub("(?+)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+class _Scope:
+    __slots__ = ("name", "counts")
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}
+
+
+class QueryProfiler:
+    """Aggregates statement timings and query plans by fingerprint."""
+
+    def __init__(self, slow_ms: float = DEFAULT_SLOW_MS):
+        self.slow_ms = slow_ms
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._local = threading.local()
+
+    def record(self, sql: str, elapsed: float, conn=None, params=()):
+        fp = fingerprint(sql)
+        elapsed_ms = elapsed * 1000.0
+        with self._lock:
+            entry = self._stats.get(fp)
+            if entry is None:
+                entry = self._stats[fp] = {
+                    "fingerprint": fp,
+                    "calls": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "slow_calls": 0,
+                    "max_per_scope": 0,
+                    "max_scope": None,
+                    "plan": None,
+                    "full_scan": False,
+                    "last_slow_at": None,
+                }
+            entry["calls"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            is_slow = elapsed_ms >= self.slow_ms
+            needs_plan = is_slow and entry["plan"] is None
+            if is_slow:
+                entry["slow_calls"] += 1
+                entry["last_slow_at"] = datetime.now().isoformat()
+        scope = getattr(self._local, "scope", None)
+        if scope is not None:
+            count = scope.counts.get(fp, 0) + 1
+            scope.counts[fp] = count
+            with self._lock:
+                if count > entry["max_per_scope"]:
+                    entry["max_per_scope"] = count
+                    entry["max_scope"] = scope.name
+        if needs_plan and conn is not None:
+            plan = explain(conn, sql, params)
+            with self._lock:
+                entry["plan"] = plan
+                entry["full_scan"] = any(_is_full_scan(detail) for detail in plan)
+
+    def begin_scope(self, name: str):
+        """Start counting repeated fingerprints for one unit of work (e.g. a Flask request)."""
+        self._local.scope = _Scope(name)
+
+    def end_scope(self):
+        self._local.scope = None
+
+    @contextmanager
+    def scope(self, name: str):
+        self.begin_scope(name)
+        try:
+            yield
+        finally:
+            self.end_scope()
+
+    def report(self) -> list:
+        """Return per-fingerprint stats sorted by total time, slowest first."""
+        with self._lock:
+            rows = [dict(entry) for entry in self._stats.values()]
+        for row in rows:
+            row["avg_ms"] = row["total_ms"] / row["calls"] if row["calls"] else 0.0
+        rows.sort(key=lambda row: row["total_ms"], reverse=True)
+        return rows
+
+    def dump_json(self, path: str = None) -> str:
+        """Serialize the report to JSON, optionally writing it to `path`."""
+        payload = json.dumps({
+            "generated_at": datetime.now().isoformat(),
+            "slow_ms": self.slow_ms,
+            "queries": self.report(),
+        }, indent=2, ensure_ascii=False)
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(payload)
+        return payload
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def explain(conn, sql: str, params=()) -> list:
+    """Return the `EXPLAIN QUERY PLAN` detail lines for a statement."""
+    try:
+        rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error as e:
+        return [f"EXPLAIN failed: {e}"]
+    return [row[-1] for row in rows]
+
+
+def _is_full_scan(detail: str) -> bool:
+    return detail.startswith("SCAN ") and "USING" not in detail
+
+
+# --- Instrumented connection classes ---
+
+PROFILER = QueryProfiler()
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that reports execute and fetch time of each statement to PROFILER."""
+
+    _sql = None
+    _params = ()
+    _elapsed = 0.0
+
+    def execute(self, sql, parameters=()):
+        self._flush()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._sql, self._params = sql, parameters
+            self._elapsed = time.perf_counter() - start
+
+    def executemany(self, sql, seq_of_parameters):
+        self._flush()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._sql, self._params = sql, None
+            self._elapsed = time.perf_counter() - start
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def close(self):
+        self._flush()
+        super().close()
+
+    def _flush(self):
+        if self._sql is None:
+            return
+        sql, params = self._sql, self._params
+        self._sql = None
+        if PROFILER.enabled:
+            # executemany plans are not captured: there is no single parameter set to explain.
+            PROFILER.record(sql, self._elapsed, self.connection if params is not None else None, params or ())
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose cursors (including conn.execute shortcuts) are profiled."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cursors = []
+
+    def cursor(self, factory=ProfiledCursor):
+        cursor = super().cursor(factory)
+        self._cursors.append(cursor)
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        for cursor in self._cursors:
+            cursor._flush()
+        self._cursors.clear()
+        super().close()
+
+
+def connect(database, **kwargs) -> sqlite3.Connection:
+    """Drop-in replacement for sqlite3.connect that profiles every statement."""
+    return sqlite3.connect(database, factory=ProfiledConnection, **kwargs)
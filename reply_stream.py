@@ -0,0 +1,163 @@
+"""
+Streamed replies: a placeholder message that is edited as the completion arrives.
+
+The completion is read in a worker thread (the OpenAI client blocks) and
+handed to the event loop through an asyncio queue. Edits are throttled per
+chat: Telegram tolerates about one edit per second in a private chat and far
+fewer in groups. A RetryAfter from Telegram pushes the next edit back instead
+of failing the reply. The last edit always carries the full text.
+
+If the completion fails after part of the reply was received, the message is
+edited one last time to that text plus an "interrupted" note, and the partial
+reply is returned like a complete one. If nothing was received (an empty
+completion, or a failure before the first token) the placeholder is deleted.
+
+Options go under `reply_streaming` in config.json:
+
+    "reply_streaming": {"enabled": true, "edit_interval": 1.0, "group_edit_interval": 3.0}
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS = {
+    "enabled": True,
+    # Sent as soon as the message is accepted, replaced by the first edit.
+    "placeholder": "…",
+    # Minimum seconds between edits in private chats and in groups.
+    "edit_interval": 1.0,
+    "group_edit_interval": 3.0,
+    # The first edit waits for this many characters, so the placeholder is not replaced by a single word.
+    "min_chars": 20,
+    # Appended to the text already received when the completion fails part way.
+    "interrupted_note": "\n\n(The reply was interrupted.)",
+}
+
+EDITS = "analyzebot_reply_edits_total"
+THROTTLED = "analyzebot_reply_edits_throttled_total"
+FIRST_TEXT = "analyzebot_reply_first_text_seconds"
+metrics.describe(EDITS, "Edits of streamed reply messages.")
+metrics.describe(THROTTLED, "Streamed reply edits postponed by a Telegram RetryAfter.")
+metrics.describe(FIRST_TEXT, "Time from starting a streamed reply to the first text shown to the user.")
+
+
+def load_options(config: dict) -> dict:
+    return dict(DEFAULT_OPTIONS, **(config.get('reply_streaming') or {}))
+
+
+async def _edit(message, text: str, interval: float):
+    """Edit `message` to `text`; returns (edited, monotonic time after which the next edit may be sent)."""
+    try:
+        await message.edit_text(text)
+    except RetryAfter as e:
+        retry_after = e.retry_after
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        metrics.inc(THROTTLED)
+        logger.info(f"Telegram asked to wait {retry_after}s before editing the reply in chat {message.chat_id}")
+        return False, time.monotonic() + retry_after
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    metrics.inc(EDITS)
+    return True, time.monotonic() + interval
+
+
+async def _delete(placeholder):
+    try:
+        await placeholder.delete()
+    except Exception as e:
+        logger.warning(f"Could not delete the reply placeholder: {e}")
+
+
+async def stream_reply(message, deltas, options: dict) -> dict:
+    """Answer `message` with the text from the blocking iterator `deltas`, editing a placeholder as it grows.
+
+    Returns the final text ("" when nothing was received), the time to the first token and to the full
+    reply (ms), the edits made and whether the completion finished.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    started = time.perf_counter()
+    # Cancelling the asyncio wrapper does not stop the thread; it checks this flag on every delta.
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for delta in deltas:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(chunks.put_nowait, delta)
+        finally:
+            # Closing the generator (core.llm) closes the OpenAI stream, so an abandoned reply stops using tokens.
+            close = getattr(deltas, "close", None)
+            if close is not None:
+                close()
+            loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+    producer = asyncio.ensure_future(asyncio.to_thread(produce))
+    interval = options["edit_interval"] if message.chat.type == "private" else options["group_edit_interval"]
+    placeholder = None
+    text = shown = ""
+    ttft = None
+    edits = 0
+    complete = True
+    try:
+        placeholder = await message.reply_text(options["placeholder"])
+        next_edit = time.monotonic()
+        while True:
+            ready = bool(text.strip()) and text != shown and (shown or len(text) >= options["min_chars"])
+            timeout = max(next_edit - time.monotonic(), 0) if ready else None
+            try:
+                delta = await asyncio.wait_for(chunks.get(), timeout)
+            except asyncio.TimeoutError:
+                delta = ""
+            if delta is None:
+                break
+            if delta and ttft is None:
+                ttft = time.perf_counter() - started
+            text += delta
+            if ready and time.monotonic() >= next_edit:
+                edited, next_edit = await _edit(placeholder, text, interval)
+                if edited:
+                    if not shown:
+                        metrics.observe(FIRST_TEXT, time.perf_counter() - started)
+                    shown = text
+                    edits += 1
+        try:
+            await producer
+        except Exception as e:
+            # The completion failed after some text arrived: keep it, marked as cut short.
+            if not text.strip():
+                raise
+            logger.warning(f"Reply completion failed after {len(text)} characters in chat {message.chat_id}: {e}")
+            text = text.strip() + options["interrupted_note"]
+            complete = False
+        text = text.strip()
+        if not text:
+            await _delete(placeholder)
+        # The final edit must land, so wait out the throttle (and any RetryAfter) for it.
+        while text and text != shown:
+            await asyncio.sleep(max(next_edit - time.monotonic(), 0))
+            edited, next_edit = await _edit(placeholder, text, interval)
+            if edited:
+                shown = text
+                edits += 1
+    except BaseException:
+        stop.set()
+        if not producer.done():
+            producer.cancel()
+        if placeholder is not None and not shown:
+            await _delete(placeholder)
+        raise
+    latency = time.perf_counter() - started
+    return {"text": text, "ttft_ms": (ttft if ttft is not None else latency) * 1000,
+            "latency_ms": latency * 1000, "edits": edits, "complete": complete}
@@ -0,0 +1,220 @@
+"""
+Retention, archival compaction and scheduled maintenance for telegram_bot.db.
+
+Old rows in Messages are rolled into one zlib-compressed JSON blob per user
+and month in MessageArchives, so the hot table and its indexes stay small
+while the history helpers can still read every message. MessageStats is left
+untouched as the long-term daily rollup. Maintenance then returns freed pages
+with an incremental VACUUM and refreshes planner statistics with ANALYZE.
+
+Incremental VACUUM needs `auto_vacuum = INCREMENTAL`. Files created by
+`init_db` start in that mode. Switching an existing file takes one full VACUUM
+that locks out writers while the whole file is rewritten. Scheduled runs never
+do that switch; do it once, with the bot stopped, via
+`python retention.py --full-vacuum`. Until then scheduled runs only ANALYZE.
+
+Run once from the command line with `python retention.py`, or let the bot run
+it on a schedule (see `retention` in config.json).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import metrics
+import query_profiler
+import storage
+from core import events
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLICY = {
+    # Messages older than this are archived...
+    "archive_after_days": 90,
+    # ...except each user's most recent ones, which the analysis reads.
+    "keep_recent_per_user": 50,
+    # Pages returned to the OS per incremental VACUUM run (0 = all free pages).
+    "vacuum_pages": 0,
+    "interval_hours": 24,
+}
+
+
+ARCHIVE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS MessageArchives (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        month TEXT,
+        message_count INTEGER,
+        first_timestamp TEXT,
+        last_timestamp TEXT,
+        payload BLOB,
+        updated_at TEXT,
+        UNIQUE(user_id, month)
+    )
+'''
+
+
+def load_policy(config: dict) -> dict:
+    return dict(DEFAULT_POLICY, **(config.get('retention') or {}))
+
+
+def _pack(rows) -> bytes:
+    return zlib.compress(json.dumps(rows, ensure_ascii=False).encode('utf-8'), 9)
+
+
+def _unpack(blob: bytes) -> list:
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+# --- Reading archives ---
+
+def archive_entries(payload: bytes) -> list:
+    """The [chat_id, content, timestamp] entries of one MessageArchives payload, oldest first."""
+    return _unpack(payload)
+
+
+def get_archived_messages(conn, user_id: int) -> list:
+    """Return archived (content, timestamp) pairs for a user, oldest first."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT payload FROM MessageArchives WHERE user_id = ? ORDER BY month", (user_id,))
+    blobs = cursor.fetchall()
+    messages = []
+    for (blob,) in blobs:
+        messages.extend((content, ts) for _chat_id, content, ts in _unpack(blob))
+    return messages
+
+
+# --- Archival ---
+
+def archive_messages(conn, archive_after_days: int, keep_recent_per_user: int) -> int:
+    """Move eligible Messages rows into MessageArchives; returns the number of rows archived."""
+    cutoff = (datetime.now() - timedelta(days=archive_after_days)).isoformat()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, user_id, chat_id, content, timestamp FROM (
+            SELECT id, user_id, chat_id, content, timestamp,
+                   ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC) AS recency
+            FROM Messages
+            WHERE timestamp IS NOT NULL AND timestamp != ''
+        ) AS ranked
+        WHERE timestamp < ? AND recency > ?
+        ORDER BY user_id, timestamp
+    ''', (cutoff, keep_recent_per_user))
+    rows = cursor.fetchall()
+    if not rows:
+        return 0
+
+    groups = {}
+    for msg_id, user_id, chat_id, content, ts in rows:
+        groups.setdefault((user_id, ts[:7]), []).append((msg_id, [chat_id, content, ts]))
+
+    now = datetime.now().isoformat()
+    for (user_id, month), items in groups.items():
+        entries = [entry for _, entry in items]
+        cursor.execute("SELECT payload FROM MessageArchives WHERE user_id = ? AND month = ?", (user_id, month))
+        existing = cursor.fetchone()
+        if existing:
+            entries = sorted(_unpack(existing[0]) + entries, key=lambda entry: entry[2])
+        cursor.execute('''
+            INSERT INTO MessageArchives (user_id, month, message_count, first_timestamp, last_timestamp, payload, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, month) DO UPDATE SET
+                message_count = excluded.message_count,
+                first_timestamp = excluded.first_timestamp,
+                last_timestamp = excluded.last_timestamp,
+                payload = excluded.payload,
+                updated_at = excluded.updated_at
+        ''', (user_id, month, len(entries), entries[0][2], entries[-1][2], _pack(entries), now))
+        cursor.executemany("DELETE FROM Messages WHERE id = ?", [(msg_id,) for msg_id, _ in items])
+    conn.commit()
+    return len(rows)
+
+
+# --- Maintenance ---
+
+def _space(cursor) -> dict:
+    page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+    page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+    free_pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    return {"bytes": page_size * page_count, "free_bytes": page_size * free_pages}
+
+
+def vacuum_and_analyze(db_file: str, vacuum_pages: int = 0, full_vacuum: bool = False) -> dict:
+    """Run an incremental VACUUM and ANALYZE; returns database size before and after.
+
+    With `full_vacuum` a file not yet in incremental mode is switched with one blocking full VACUUM.
+    """
+    conn = query_profiler.connect(db_file, isolation_level=None)
+    cursor = conn.cursor()
+    before = _space(cursor)
+    if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        cursor.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+        cursor.fetchall()
+    elif full_vacuum:
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+    else:
+        logger.warning(f"{db_file} is not in incremental auto_vacuum mode, skipping VACUUM; "
+                       f"run `python retention.py --full-vacuum` once with the bot stopped")
+    after = _space(cursor)
+    cursor.execute("ANALYZE")
+    conn.close()
+    return {"bytes_before": before["bytes"], "bytes_after": after["bytes"],
+            "reclaimed_bytes": before["bytes"] - after["bytes"]}
+
+
+def run_retention(policy: dict, full_vacuum: bool = False) -> dict:
+    """Archive old messages on every shard, then compact and analyze each SQLite file."""
+    started = time.perf_counter()
+    report = {"bytes_before": 0, "bytes_after": 0, "reclaimed_bytes": 0}
+    with metrics.span("retention.run"):
+        archived = sum(storage.fan_out(
+            lambda conn: archive_messages(conn, policy["archive_after_days"], policy["keep_recent_per_user"])))
+        pruned_events = events.prune_events()
+        # MySQL manages its own space; only SQLite files are vacuumed here.
+        for db_file in storage.backend().database_files():
+            for key, value in vacuum_and_analyze(db_file, policy["vacuum_pages"], full_vacuum).items():
+                report[key] += value
+    report["archived_messages"] = archived
+    report["pruned_events"] = pruned_events
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    metrics.inc("analyzebot_retention_archived_messages_total", archived)
+    metrics.set_gauge("analyzebot_db_size_bytes", report["bytes_after"])
+    logger.info(f"Retention run: archived {archived} messages, reclaimed {report['reclaimed_bytes']} bytes "
+                f"({report['bytes_before']} -> {report['bytes_after']}) in {report['seconds']}s")
+    return report
+
+
+async def run_periodically(policy: dict):
+    """Run retention every `interval_hours` from the bot's event loop (work happens in a thread)."""
+    while True:
+        try:
+            await asyncio.to_thread(run_retention, policy)
+        except Exception as e:
+            logger.error(f"Retention run failed: {e}")
+        await asyncio.sleep(policy["interval_hours"] * 3600)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Archive old messages and compact telegram_bot.db")
+    parser.add_argument('--db', default='telegram_bot.db')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--full-vacuum', action='store_true',
+                        help="switch files to incremental auto_vacuum with one full VACUUM (blocks writers; stop the bot)")
+    args = parser.parse_args()
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as file:
+            config = json.load(file)
+    storage.configure(config, args.db)
+    for conn in storage.connect_all():
+        conn.execute(ARCHIVE_TABLE_SQL)
+        conn.execute(events.EVENTS_TABLE_SQL)
+        conn.commit()
+        conn.close()
+    print(json.dumps(run_retention(load_policy(config), args.full_vacuum), indent=2))
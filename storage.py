@@ -0,0 +1,288 @@
+"""
+Storage backends behind the database helper functions.
+
+The helpers in core/db.py keep their SQL; they only ask this module for a
+connection. The backend is opened on first use, and which database answers
+is chosen by the `storage` section of config.json:
+
+- "sqlite" (default): everything lives in telegram_bot.db, as before.
+- "sharded_sqlite": per-user tables are spread over N SQLite files by
+  `user_id % N`, so writers for different users do not contend for one file
+  lock. Bot-wide state (conversation persistence, ...) stays in the main file.
+  Dashboard aggregates fan out to every shard in parallel and are merged.
+- "mysql": a pooled mysql.connector connection. Statements written for SQLite
+  are translated on the fly (placeholders, upserts, DDL types).
+
+    "storage": {"backend": "sharded_sqlite", "shards": 4, "shard_path": "telegram_bot.shard{}.db"}
+    "storage": {"backend": "mysql", "mysql": {"host": "...", "user": "...", "password": "...",
+                "database": "...", "pool_size": 8}}
+"""
+import functools
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import query_profiler
+from core.config import DB_FILE, get_config
+
+
+class SQLiteBackend:
+    """A single SQLite file for everything."""
+
+    name = "sqlite"
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+
+    @property
+    def shard_count(self) -> int:
+        return 1
+
+    def connect(self, user_id: int = None):
+        return query_profiler.connect(self.db_file)
+
+    def connect_shard(self, index: int):
+        return query_profiler.connect(self.db_file)
+
+    def database_files(self) -> list:
+        return [self.db_file]
+
+
+class ShardedSQLiteBackend(SQLiteBackend):
+    """Per-user data in `shards` SQLite files chosen by user_id; bot-wide data in the main file."""
+
+    name = "sharded_sqlite"
+
+    def __init__(self, db_file: str, shards: int, shard_path: str):
+        super().__init__(db_file)
+        self.shard_files = [shard_path.format(i) for i in range(shards)]
+
+    @property
+    def shard_count(self) -> int:
+        return len(self.shard_files)
+
+    def shard_for(self, user_id: int) -> int:
+        return user_id % len(self.shard_files)
+
+    def connect(self, user_id: int = None):
+        if user_id is None:
+            return query_profiler.connect(self.db_file)
+        return query_profiler.connect(self.shard_files[self.shard_for(user_id)])
+
+    def connect_shard(self, index: int):
+        return query_profiler.connect(self.shard_files[index])
+
+    def database_files(self) -> list:
+        return [self.db_file] + self.shard_files
+
+
+# --- MySQL ---
+
+# Columns that hold free text and must stay TEXT; other TEXT columns become indexable VARCHARs.
+_LONG_TEXT_COLUMNS = ("content", "analysis_result", "data", "prompt", "reply", "payload")
+
+
+@functools.lru_cache(maxsize=512)
+def translate_sql(sql: str) -> str:
+    """Rewrite a statement written for SQLite into MySQL syntax."""
+    sql = sql.replace("%", "%%").replace("?", "%s")
+    sql = re.sub(r"\bINSERT OR REPLACE\b", "REPLACE", sql)
+    sql = re.sub(r"\bINSERT OR IGNORE\b", "INSERT IGNORE", sql)
+    sql = re.sub(r"\bON CONFLICT\s*\([^)]*\)\s*DO UPDATE SET\b", "ON DUPLICATE KEY UPDATE", sql)
+    sql = re.sub(r"\bexcluded\.(\w+)", r"VALUES(\1)", sql)
+    if re.match(r"\s*CREATE\s+TABLE", sql, re.IGNORECASE):
+        sql = sql.replace("AUTOINCREMENT", "AUTO_INCREMENT")
+        # Telegram ids no longer fit in 32 bits.
+        sql = re.sub(r"\bINTEGER\b", "BIGINT", sql)
+        sql = re.sub(r",\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\)", "", sql)
+        long_columns = "|".join(_LONG_TEXT_COLUMNS)
+        sql = re.sub(rf"\b(?!(?:{long_columns})\b)(\w+) TEXT\b", r"\1 VARCHAR(191)", sql)
+        sql = re.sub(r"\bBLOB\b", "LONGBLOB", sql)
+    sql = re.sub(r"\bCREATE (UNIQUE )?INDEX IF NOT EXISTS\b", r"CREATE \1INDEX", sql)
+    sql = re.sub(r"\bCREATE VIEW IF NOT EXISTS\b", "CREATE OR REPLACE VIEW", sql)
+    return sql
+
+
+class _MySQLCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, parameters=()):
+        try:
+            self._cursor.execute(translate_sql(sql), tuple(parameters))
+        except Exception as e:
+            # MySQL has no CREATE INDEX IF NOT EXISTS; an existing index (1061) is fine.
+            if getattr(e, "errno", None) != 1061:
+                raise
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        rows = [tuple(parameters) for parameters in seq_of_parameters]
+        if rows:
+            self._cursor.executemany(translate_sql(sql), rows)
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor.fetchall())
+
+
+class _MySQLConnection:
+    """Wraps a pooled connection with the sqlite3-style calls the helpers use."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        # Buffered, like sqlite3: helpers fetchone() and move on (or close) with rows still pending,
+        # which an unbuffered mysql.connector cursor rejects with "Unread result found".
+        return _MySQLCursor(self._conn.cursor(buffered=True))
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        # Returns the connection to the pool.
+        self._conn.close()
+
+
+class MySQLBackend:
+    """All data in one MySQL database reached through a connection pool."""
+
+    name = "mysql"
+    shard_count = 1
+
+    def __init__(self, options: dict):
+        import mysql.connector.pooling
+
+        options = dict(options)
+        pool_size = options.pop("pool_size", 8)
+        self._pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name="analyzebot", pool_size=pool_size, pool_reset_session=True, **options)
+
+    def connect(self, user_id: int = None):
+        return _MySQLConnection(self._pool.get_connection())
+
+    def connect_shard(self, index: int):
+        return self.connect()
+
+    def database_files(self) -> list:
+        return []
+
+
+# --- Module-level backend used by the helpers ---
+
+BACKEND = None
+_fan_out_pool = None
+_configure_lock = threading.Lock()
+
+
+def configure(config: dict, db_file: str):
+    """Create the backend described by config['storage'] (defaults to the single SQLite file)."""
+    global BACKEND, _fan_out_pool
+    options = config.get("storage") or {}
+    backend = options.get("backend", "sqlite")
+    if backend == "sharded_sqlite":
+        BACKEND = ShardedSQLiteBackend(db_file, options.get("shards", 4),
+                                       options.get("shard_path", "telegram_bot.shard{}.db"))
+    elif backend == "mysql":
+        BACKEND = MySQLBackend(options.get("mysql", {}))
+    else:
+        BACKEND = SQLiteBackend(db_file)
+    if BACKEND.shard_count > 1:
+        _fan_out_pool = ThreadPoolExecutor(max_workers=BACKEND.shard_count, thread_name_prefix="shard")
+    return BACKEND
+
+
+def backend():
+    """The configured backend; built from config.json on first use unless `configure` was called."""
+    if BACKEND is None:
+        with _configure_lock:
+            if BACKEND is None:
+                config = get_config()
+                query_profiler.PROFILER.slow_ms = config.get('slow_query_ms', query_profiler.DEFAULT_SLOW_MS)
+                configure(config, DB_FILE)
+    return BACKEND
+
+
+def connect(user_id: int = None):
+    """Connection holding `user_id`'s rows, or the main database when no user is given."""
+    return backend().connect(user_id)
+
+
+def connect_all() -> list:
+    """One connection per database that needs the schema (main file plus every shard)."""
+    if isinstance(backend(), ShardedSQLiteBackend):
+        return [query_profiler.connect(path) for path in BACKEND.database_files()]
+    return [BACKEND.connect()]
+
+
+def fan_out(query, with_index: bool = False):
+    """Run `query(conn)` on every shard (in parallel when sharded) and return the results in shard order.
+
+    With `with_index`, the shard index is passed as well: `query(conn, index)`.
+    """
+    shards = backend()
+
+    def run(index):
+        conn = shards.connect_shard(index)
+        try:
+            return query(conn, index) if with_index else query(conn)
+        finally:
+            conn.close()
+
+    if _fan_out_pool is None:
+        return [run(0)]
+    return list(_fan_out_pool.map(run, range(shards.shard_count)))
+
+
+# --- Moving an existing single-file database into shards ---
+
+# Per-user tables and the column that decides their shard.
+SHARDED_TABLES = {
+    "Chats": "chat_id",
+    "Messages": "user_id",
+    "MessageStats": "user_id",
+    "Analyses": "user_id",
+    "Authorizations": "user_id",
+    "UserMentalHealth": "user_id",
+    "RiskHistory": "user_id",
+    "MessageArchives": "user_id",
+    "Replies": "user_id",
+    "Events": "user_id",
+}
+
+
+def migrate_to_shards(backend: ShardedSQLiteBackend) -> dict:
+    """Move per-user rows from the main file into the shard files; returns rows moved per table."""
+    moved = {}
+    shards = backend.shard_count
+    conn = query_profiler.connect(backend.db_file)
+    try:
+        for index, shard_file in enumerate(backend.shard_files):
+            conn.execute("ATTACH DATABASE ? AS shard", (shard_file,))
+            for table, column in SHARDED_TABLES.items():
+                # SQLite's % keeps the sign of negative (group chat) ids; Python's does not.
+                cursor = conn.execute(
+                    f"INSERT OR IGNORE INTO shard.{table} SELECT * FROM main.{table} "
+                    f"WHERE (({column} % ?) + ?) % ? = ?", (shards, shards, shards, index))
+                moved[table] = moved.get(table, 0) + cursor.rowcount
+            conn.commit()
+            conn.execute("DETACH DATABASE shard")
+        for table in SHARDED_TABLES:
+            conn.execute(f"DELETE FROM main.{table}")
+        conn.commit()
+    finally:
+        conn.close()
+    return moved
@@ -0,0 +1,61 @@
+"""Risk scoring: histories too short to score write nothing and never flag the user."""
+import sqlite3
+
+import pytest
+
+import bot_mentalx
+import storage
+from core import db, llm
+
+USER_ID = 4242
+SHORT_HISTORY = "hi\nhow are you"
+
+
+class _UnusedModel:
+    """Fails the test if a completion is requested."""
+
+    def __init__(self):
+        self.chat = self
+        self.completions = self
+
+    def create(self, **request):
+        raise AssertionError("the model must not be called for a short history")
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    path = str(tmp_path / "bot.db")
+    monkeypatch.setattr(storage, "BACKEND", storage.SQLiteBackend(path))
+    monkeypatch.setattr(llm, "_client_override", _UnusedModel())
+    db.init_db()
+    return path
+
+
+def _rows(path, sql):
+    conn = sqlite3.connect(path)
+    rows = conn.execute(sql, (USER_ID,)).fetchall()
+    conn.close()
+    return rows
+
+
+def _risk_history(path):
+    return _rows(path, "SELECT mental_percent FROM RiskHistory WHERE user_id = ?")
+
+
+def test_short_history_has_no_score():
+    assert llm.get_mental_health_percentage(SHORT_HISTORY) is None
+
+
+def test_short_history_writes_nothing(database):
+    assert bot_mentalx.update_risk_score(USER_ID, SHORT_HISTORY) is None
+    assert _risk_history(database) == []
+    assert db.get_user_mental_health(USER_ID) == (None, None, None)
+    assert _rows(database, "SELECT kind FROM Events WHERE user_id = ?") == []
+
+
+def test_first_real_score_is_not_deteriorating(database):
+    for _ in range(3):
+        bot_mentalx.update_risk_score(USER_ID, SHORT_HISTORY)
+    db.update_user_mental_health(USER_ID, 35.0, "Orange")
+    assert _risk_history(database) == [(35.0,)]
+    assert USER_ID not in [row[0] for row in db.get_deteriorating_users()]
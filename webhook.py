@@ -0,0 +1,318 @@
+"""
+Webhook deployment mode for the bot.
+
+A small HTTP receiver accepts Telegram updates and routes each one to one of
+several worker processes by hashing its user id. Every worker runs its own
+python-telegram-bot Application, so a user's updates are always handled by
+the same process in arrival order while different users are spread across
+cores. On SIGINT/SIGTERM the receiver stops accepting updates, each worker
+finishes everything already queued, and the processes exit.
+
+The same routing can be driven from a file of recorded updates (one JSON
+update per line) for local testing without Telegram delivering webhooks.
+Replay is fully offline: the workers answer Bot API calls locally (sent and
+edited messages are only logged), completions come from a canned offline
+model, and every row is written to a scratch SQLite file (`replay_db`,
+default replay.db) that is recreated for each replay.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from telegram import Bot, Update
+from telegram.request import BaseRequest
+
+import metrics
+import query_profiler
+from core.config import DB_FILE, get_config
+
+logger = logging.getLogger(__name__)
+
+# Fields of an Update that carry the acting user, in priority order.
+_UPDATE_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+    'chat_join_request', 'channel_post', 'edited_channel_post',
+)
+
+
+def route_key(update: dict) -> int:
+    """Return the id that decides which worker handles an update (user, then chat, then update id)."""
+    for field in _UPDATE_FIELDS:
+        obj = update.get(field)
+        if not obj:
+            continue
+        user = obj.get('from') or obj.get('user')
+        if user:
+            return user['id']
+        chat = obj.get('chat')
+        if chat:
+            return chat['id']
+    return update.get('update_id', 0)
+
+
+# --- Offline replay ---
+
+_BOT_USER = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+
+
+class OfflineRequest(BaseRequest):
+    """Bot API transport that answers every call locally; sent and edited messages are only logged."""
+
+    def __init__(self):
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        logger.info(f"replay {api_method}: {params}")
+        if api_method == 'getMe':
+            result = _BOT_USER
+        elif api_method in ('sendMessage', 'editMessageText'):
+            result = {
+                "message_id": params.get('message_id') or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": params.get('chat_id', 0), "type": "private"},
+                "from": _BOT_USER,
+                "text": params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class OfflineCompletions:
+    """Stands in for the OpenAI client during replay: fixed answers in the format each call expects."""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, messages, stream=False, **request):
+        system = messages[0]["content"]
+        if system == "Analyzing user conversation history.":
+            text = "no: replayed offline"
+        elif system == "Analyze mental health risk.":
+            text = "0: Green"
+        else:
+            text = f"[replay] {messages[-1]['content'][:200]}"
+        tokens = SimpleNamespace(prompt_tokens=0, completion_tokens=0)
+        if stream:
+            delta = SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+            # A generator, like the client's Stream it can be closed.
+            return (chunk for chunk in [delta, SimpleNamespace(choices=[], usage=tokens)])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=tokens)
+
+
+def _use_replay_db(replay_db: str):
+    """Point this process's storage at the scratch replay database (always a single SQLite file)."""
+    import storage
+    from core.db import init_db
+
+    storage.configure({}, replay_db)
+    init_db()
+
+
+# --- Worker processes ---
+
+def _worker_main(index: int, queue, metrics_port: int, replay_db: str = None):
+    """Entry point of a worker process: run one Application fed from `queue` (offline when replaying)."""
+    # Shutdown is coordinated by the receiver through the queue, not by signals.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    import bot_mentalx
+
+    metrics.start_http_server(metrics_port)
+    if replay_db:
+        from core import llm
+
+        _use_replay_db(replay_db)
+        llm.use_client(OfflineCompletions())
+        application = bot_mentalx.build_application(OfflineRequest(), OfflineRequest())
+    else:
+        application = bot_mentalx.build_application()
+    # Retention is scheduled once, by the receiver, not by every worker.
+    application.bot_data['run_retention'] = False
+    asyncio.run(_serve_worker(application, queue))
+    profile_path = get_config().get('query_profile_path')
+    if profile_path:
+        query_profiler.PROFILER.dump_json(f"{profile_path}.{index}")
+
+
+async def _serve_worker(application, queue):
+    loop = asyncio.get_running_loop()
+    async with application:
+        # post_init hooks only run automatically from run_polling()/run_webhook().
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        while True:
+            payload = await loop.run_in_executor(None, queue.get)
+            if payload is None:
+                break
+            await application.update_queue.put(Update.de_json(payload, application.bot))
+        # Application.stop() processes every update still in update_queue before returning.
+        await application.stop()
+
+
+class UpdateRouter:
+    """Owns the worker processes and hands each update to the worker for its user."""
+
+    def __init__(self, workers: int, metrics_port: int, replay_db: str = None):
+        self._ctx = multiprocessing.get_context('spawn')
+        self._queues = [self._ctx.Queue() for _ in range(workers)]
+        self._processes = [
+            self._ctx.Process(target=_worker_main, args=(i, q, metrics_port + 1 + i, replay_db),
+                              name=f'bot-worker-{i}')
+            for i, q in enumerate(self._queues)
+        ]
+        self._closed = False
+        for i, q in enumerate(self._queues):
+            metrics.gauge_callback("analyzebot_webhook_queue_depth", q.qsize, worker=i)
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+
+    def dispatch(self, update: dict) -> bool:
+        if self._closed:
+            return False
+        worker = route_key(update) % len(self._queues)
+        self._queues[worker].put(update)
+        metrics.inc("analyzebot_webhook_updates_total", worker=worker)
+        return True
+
+    def drain(self, timeout: float = 60.0):
+        """Stop accepting updates, let every worker finish its queue and wait for them to exit."""
+        self._closed = True
+        for q in self._queues:
+            q.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not drain within {timeout}s, terminating")
+                process.terminate()
+
+
+# --- HTTP receiver ---
+
+def _make_handler(router: UpdateRouter, path: str, secret: str, record_path: str):
+    record_lock = threading.Lock()
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self.send_error(404)
+                return
+            if secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+                self.send_error(403)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                update = json.loads(body)
+            except ValueError:
+                self.send_error(400)
+                return
+            if not router.dispatch(update):
+                # Draining: Telegram keeps the update and redelivers it after restart.
+                self.send_error(503)
+                return
+            if record_path:
+                with record_lock, open(record_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(update, ensure_ascii=False) + '\n')
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return WebhookHandler
+
+
+def replay(router: UpdateRouter, replay_path: str) -> int:
+    """Dispatch recorded updates from a JSON-lines file; returns the number sent."""
+    count = 0
+    with open(replay_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                router.dispatch(json.loads(line))
+                count += 1
+    return count
+
+
+def _reset_replay_db(replay_db: str):
+    if os.path.abspath(replay_db) == os.path.abspath(DB_FILE):
+        raise SystemExit(f"replay_db must not be the bot database ({DB_FILE})")
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(replay_db + suffix):
+            os.remove(replay_db + suffix)
+    _use_replay_db(replay_db)
+
+
+def run(config: dict, workers: int = 2, replay_path: str = None):
+    """Run the webhook receiver (or an offline replay) with `workers` worker processes until stopped."""
+    metrics_port = config.get('metrics_port', 9108)
+    replay_db = None
+    if replay_path:
+        replay_db = config.get('replay_db', 'replay.db')
+        _reset_replay_db(replay_db)
+    router = UpdateRouter(max(1, workers), metrics_port, replay_db)
+    router.start()
+    metrics.start_http_server(metrics_port)
+
+    if replay_path:
+        count = replay(router, replay_path)
+        logger.info(f"Replayed {count} updates from {replay_path} into {replay_db}, draining workers")
+        router.drain()
+        return
+
+    path = config.get('webhook_path', '/telegram')
+    secret = config.get('webhook_secret', '')
+    handler = _make_handler(router, path, secret, config.get('webhook_record_path'))
+    server = ThreadingHTTPServer((config.get('webhook_listen', '0.0.0.0'), config.get('webhook_port', 8443)), handler)
+
+    if config.get('webhook_url'):
+        bot = Bot(config['telegram_bot_token'])
+        # Parallel deliveries from Telegram could reorder one user's updates before routing,
+        # so by default a single connection feeds the receiver (it only enqueues, which is cheap).
+        asyncio.run(bot.set_webhook(url=config['webhook_url'], secret_token=secret or None,
+                                    allowed_updates=Update.ALL_TYPES,
+                                    max_connections=config.get('webhook_max_connections', 1)))
+
+    if 'retention' in config:
+        import retention
+
+        threading.Thread(target=asyncio.run, args=(retention.run_periodically(retention.load_policy(config)),),
+                         name='retention', daemon=True).start()
+
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    threading.Thread(target=server.serve_forever, name='webhook-http', daemon=True).start()
+    logger.info(f"Webhook receiver listening on {server.server_address} with {workers} workers")
+    stop.wait()
+
+    logger.info("Shutting down: closing receiver and draining workers")
+    server.shutdown()
+    router.drain()
+    server.server_close()